@@ -0,0 +1,222 @@
+"""
+Бенчмарк RAG-поиска: recall@k, задержки p50/p99, время построения и память
+для точного, квантованного (int8), приближённого (IVF) и гибридного поиска.
+
+Примеры:
+    python bench_retrieval.py --docs 20000 --dim 1536 --queries 500
+    python bench_retrieval.py --dump doc_chunks.jsonl --queries 300 --output bench.json
+
+Дамп doc_chunks — JSON-массив или JSONL со строками {"id", "chunk_text", "embedding"}
+(embedding — список чисел или JSON-строка, как в таблице).
+Результат печатается как JSON (stdout или --output), краткая таблица — в stderr.
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+from typing import List, Dict, Any
+
+import numpy as np
+
+from vector_search import RetrievalIndex
+
+
+# =============================================================================
+# Корпуса
+# =============================================================================
+
+def synthetic_corpus(n_docs: int, dim: int, n_topics: int, seed: int) -> List[Dict[str, Any]]:
+    """
+    Кластеризованные векторы (темы) и тексты из словаря темы,
+    чтобы лексический поиск тоже было на чём мерить.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    assign = rng.integers(0, n_topics, size=n_docs)
+    vectors = topics[assign] + 0.6 * rng.normal(size=(n_docs, dim)).astype(np.float32)
+
+    vocab = [f"слово{i}" for i in range(n_topics * 20)]
+    rows = []
+    for i in range(n_docs):
+        topic_words = vocab[assign[i] * 20:(assign[i] + 1) * 20]
+        words = rng.choice(topic_words, size=8).tolist() + [f"док{i}", f"{i % 100}.{i % 7}"]
+        rows.append({"id": i + 1, "chunk_text": " ".join(words), "embedding": vectors[i]})
+    return rows
+
+
+def load_dump(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read().strip()
+    if raw.startswith("["):
+        rows = json.loads(raw)
+    else:
+        rows = [json.loads(line) for line in raw.splitlines() if line.strip()]
+    for r in rows:
+        if isinstance(r.get("embedding"), str):
+            r["embedding"] = json.loads(r["embedding"])
+    return [r for r in rows if r.get("embedding")]
+
+
+def make_queries(rows: List[Dict[str, Any]], n_queries: int, noise: float, seed: int) -> tuple:
+    """
+    Запросы — зашумлённые эмбеддинги случайных чанков и половина слов их текста.
+    Возвращает (тексты, векторы, id исходных чанков).
+    """
+    rng = np.random.default_rng(seed + 1)
+    picks = rng.choice(len(rows), size=min(n_queries, len(rows)), replace=False)
+    texts, vectors, sources = [], [], []
+    for p in picks:
+        vec = np.asarray(rows[p]["embedding"], dtype=np.float32)
+        vec = vec / (np.linalg.norm(vec) or 1.0)
+        vectors.append(vec + noise * rng.normal(size=vec.shape).astype(np.float32) / np.sqrt(len(vec)))
+        words = rows[p]["chunk_text"].split()
+        texts.append(" ".join(words[: max(1, len(words) // 2)]))
+        sources.append(rows[p]["id"])
+    return texts, np.stack(vectors), sources
+
+
+# =============================================================================
+# Замеры
+# =============================================================================
+
+def build(rows, vector_index: str) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = RetrievalIndex(rows, vector_index=vector_index)
+    build_s = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, build_s, peak
+
+
+def run_queries(index: RetrievalIndex, mode: str, texts, vectors, top_k: int) -> tuple:
+    """Прогоняет запросы по одному (как в боте); возвращает (id, задержки в мс)."""
+    found, latencies = [], []
+    for text, vec in zip(texts, vectors):
+        started = time.perf_counter()
+        if mode == "lexical":
+            res = index.search_lexical(text, top_k)
+        elif mode == "hybrid":
+            res = index.search_hybrid(text, vec, top_k)
+        else:
+            res = index.search_vector(vec, top_k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found.append([r["id"] for r in res])
+    return found, latencies
+
+
+def run_batch(index: RetrievalIndex, mode: str, texts, vectors, top_k: int) -> float:
+    """Пакетный прогон через search_many; возвращает общее время в мс."""
+    started = time.perf_counter()
+    index.search_many(texts, list(vectors), top_k, mode=mode)
+    return (time.perf_counter() - started) * 1000
+
+
+def recall_at_k(found: List[List[int]], truth: List[List[int]]) -> float:
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    total = sum(len(t) for t in truth)
+    return hits / total if total else 0.0
+
+
+def source_hit_rate(found: List[List[int]], sources: List[int]) -> float:
+    return sum(1 for f, s in zip(found, sources) if s in f) / len(sources) if sources else 0.0
+
+
+# Вариант бенчмарка -> (тип векторного индекса, режим поиска)
+METHODS = {
+    "exact": ("exact", "vector"),
+    "int8": ("int8", "vector"),
+    "ivf": ("ivf", "vector"),
+    "lexical": ("exact", "lexical"),
+    "hybrid": ("exact", "hybrid"),
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк RAG-поиска")
+    parser.add_argument("--dump", help="Дамп doc_chunks (JSON / JSONL) вместо синтетики")
+    parser.add_argument("--docs", type=int, default=10000, help="Размер синтетического корпуса")
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность синтетических векторов")
+    parser.add_argument("--topics", type=int, default=50, help="Число тем (кластеров) в синтетике")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--noise", type=float, default=0.3, help="Шум, добавляемый к векторам запросов")
+    parser.add_argument("--methods", default=",".join(METHODS), help="Через запятую: " + ", ".join(METHODS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    if args.dump:
+        rows = load_dump(args.dump)
+        corpus = {"source": args.dump}
+    else:
+        rows = synthetic_corpus(args.docs, args.dim, args.topics, args.seed)
+        corpus = {"source": "synthetic", "topics": args.topics, "seed": args.seed}
+    if not rows:
+        print("Корпус пуст", file=sys.stderr)
+        return 1
+    corpus.update(docs=len(rows), dim=len(rows[0]["embedding"]))
+
+    texts, vectors, sources = make_queries(rows, args.queries, args.noise, args.seed)
+
+    # Эталон — точный поиск по векторам
+    indexes = {"exact": build(rows, "exact")}
+    truth, _ = run_queries(indexes["exact"][0], "vector", texts, vectors, args.top_k)
+
+    results = []
+    for name in [m.strip() for m in args.methods.split(",") if m.strip()]:
+        if name not in METHODS:
+            parser.error(f"Неизвестный метод: {name}")
+        vector_index, mode = METHODS[name]
+        if vector_index not in indexes:
+            indexes[vector_index] = build(rows, vector_index)
+        index, build_s, peak = indexes[vector_index]
+
+        found, latencies = run_queries(index, mode, texts, vectors, args.top_k)
+        batch_ms = run_batch(index, mode, texts, vectors, args.top_k)
+        results.append({
+            "method": name,
+            "vector_index": vector_index,
+            "mode": mode,
+            f"recall@{args.top_k}": round(recall_at_k(found, truth), 4),
+            f"source_hit@{args.top_k}": round(source_hit_rate(found, sources), 4),
+            "latency_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+            "latency_ms_p99": round(float(np.percentile(latencies, 99)), 3),
+            "batch_ms_per_query": round(batch_ms / len(texts), 4),
+            "build_s": round(build_s, 3),
+            "build_peak_mb": round(peak / 2**20, 2),
+            "vector_index_mb": round(index.vector.nbytes / 2**20, 2),
+        })
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "corpus": corpus,
+        "queries": len(texts),
+        "top_k": args.top_k,
+        "results": results,
+    }
+
+    out = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(out)
+    else:
+        print(out)
+
+    for r in results:
+        print(
+            f"{r['method']:>8}  recall={r[f'recall@{args.top_k}']:.3f}  "
+            f"p50={r['latency_ms_p50']:.2f}ms  p99={r['latency_ms_p99']:.2f}ms  "
+            f"build={r['build_s']:.2f}s  index={r['vector_index_mb']:.1f}MB",
+            file=sys.stderr
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import heapq
+import asyncio
+import logging
+from datetime import date
+from operator import itemgetter
+from typing import Optional
+
+from cachetools import LRUCache
+
+from config import config
+from metrics import metrics
+from openai_module import get_standalone_answer
+from single_flight import SingleFlight
+from vector_search import index_version, vectorSearch
+
+
+def callback_question(callback_data: str) -> str:
+    """Текст «user-сообщения» о нажатии кнопки (так он и сохраняется в историю)."""
+    return f"Нажата кнопка (callback_data): {callback_data}"
+
+
+# =============================================================================
+# Готовые ответы на инлайн-кнопки
+# =============================================================================
+
+class _Answer:
+    __slots__ = ("text", "kb_version", "day")
+
+    def __init__(self, text: str, kb_version: int, day: date):
+        self.text = text
+        self.kb_version = kb_version
+        self.day = day
+
+    def fresh(self) -> bool:
+        # Ответ устаревает при изменении базы знаний и со сменой дня
+        # (в промпте — текущая дата: «ближайшая тренировка» меняется)
+        return self.kb_version == index_version() and self.day == date.today()
+
+
+class CallbackAnswerStore:
+    """
+    Ответ на каждое значение callback_data считается один раз и отдаётся
+    всем, кто нажал ту же кнопку, пока не изменилась база знаний или дата.
+    Одновременные нажатия одной кнопки ждут один и тот же запрос к GPT.
+    Популярность кнопок считается, чтобы prewarm() заранее обновлял
+    ответы для самых частых из них; счётчики — в LRU, чтобы произвольные
+    callback_data не копились бесконечно.
+    """
+
+    def __init__(self, maxsize: int):
+        self._answers: LRUCache = LRUCache(maxsize=maxsize)
+        self._in_flight = SingleFlight()
+        self.popularity: LRUCache = LRUCache(maxsize=maxsize * 4)
+
+    async def get(self, callback_data: str) -> Optional[str]:
+        """Готовый ответ (из кеша или свежий); None, если GPT не ответил."""
+        self.popularity[callback_data] = self.popularity.get(callback_data, 0) + 1
+        answer = self._answers.get(callback_data)
+        if answer is not None and answer.fresh():
+            metrics.inc("callback_answers.hit")
+            return answer.text
+        metrics.inc("callback_answers.miss")
+        return await self._compute(callback_data)
+
+    async def _compute(self, callback_data: str) -> Optional[str]:
+        async def generate():
+            # Версию и дату фиксируем до запроса: если база изменится, пока
+            # GPT отвечает, ответ сразу будет считаться устаревшим
+            kb_version, day = index_version(), date.today()
+            question = callback_question(callback_data)
+            try:
+                chunks = await vectorSearch(question, 3)
+            except Exception as e:
+                logging.error(f"RAG-поиск для кнопки {callback_data!r} не удался: {e}")
+                return None
+            text = await get_standalone_answer(question, rag_chunks=chunks)
+            if text is not None:
+                self._answers[callback_data] = _Answer(text, kb_version, day)
+            return text
+
+        text, _ = await self._in_flight.run(callback_data, generate)
+        return text
+
+    async def prewarm(self) -> None:
+        """
+        Обновляет устаревшие ответы для config.CALLBACK_PREWARM (известные
+        кнопки) и config.CALLBACK_PREWARM_TOP самых нажимаемых.
+        """
+        wanted = list(config.CALLBACK_PREWARM)
+        top = heapq.nlargest(config.CALLBACK_PREWARM_TOP, self.popularity.items(), key=itemgetter(1))
+        wanted += [data for data, _ in top]
+        stale = [
+            data for data in dict.fromkeys(wanted)
+            if not (self._answers.get(data) and self._answers[data].fresh())
+        ]
+        if not stale:
+            return
+        results = await asyncio.gather(*(self._compute(data) for data in stale), return_exceptions=True)
+        warmed = sum(1 for r in results if isinstance(r, str))
+        metrics.inc("callback_answers.prewarmed", warmed)
+        logging.info(f"Ответы на кнопки: обновлено {warmed} из {len(stale)}")
+
+
+callback_answers = CallbackAnswerStore(maxsize=config.CALLBACK_CACHE_SIZE)
+
+
+async def prewarm_callback_answers():
+    """Периодическая задача (main.py): обновить ответы частых кнопок."""
+    await callback_answers.prewarm()
@@ -1,8 +1,8 @@
-import os
 import json
+import time
 import logging
 import asyncio
-from typing import List
+from typing import List, Optional
 
 from aiogram import Router, F, flags
 from aiogram.filters import Command
@@ -12,26 +12,30 @@ from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 
 from config import config
 
 # Здесь вы импортируете свои модули (аналог db.php, openai.php, vector_search.php)
-# Предположим, у вас есть такие функции:
-from db import (
-    getUserByTelegramId,
-    createUser,
-    saveChatMessage,
-    getLastMessages
-)
-from vector_search import vectorSearch
+from vector_search import vectorSearch, embed_query
 from openai_module import (
     get_gpt_chat_with_history,
-    send_to_whisper
+    stream_gpt_chat_with_history
 )
+from transcription import transcribe_voice
 
-from data_manager import check_and_add_user
+from data_manager import (
+    check_and_add_user,
+    get_history,
+    save_history_message,
+    compress_history
+)
+from debounce import text_debouncer
+from dispatcher import turn_dispatcher
+from callback_answers import callback_answers, callback_question
+from notifications import manager_notifications
+from metrics import metrics
 
 communicator_router = Router()
 
@@ -54,6 +58,7 @@ async def notify_manager(
     """
     Аналог notifyManager(...) из PHP.
     Уведомляем менеджера сообщением «Упоминание менеджера! Автор: ...».
+    Упоминания идут срочной полосой (NOTIFY_URGENT_KINDS), мимо сводок.
     """
     display_name = f"@{from_username}" if from_username else "(без username)"
 
@@ -65,10 +70,8 @@ async def notify_manager(
     if context:
         msg += "\n\n--*Контекст (последние сообщения)*--:\n" + context
 
-    try:
-        await bot.send_message(chat_id=manager_chat_id, text=msg)
-    except TelegramBadRequest as e:
-        logging.error(f"Ошибка при уведомлении менеджера: {e}")
+    if manager_chat_id:
+        await manager_notifications.notify(bot, "mention", msg)
 
 
 def convertDoubleAsterisksToTelegram(text: str) -> str:
@@ -100,28 +103,150 @@ def extractButtonsFromGptReply(gptReply: str) -> List[dict]:
     return []
 
 
-async def download_telegram_voice(bot, file_id: str) -> str | None:
+# Лимит длины сообщения Telegram
+TELEGRAM_TEXT_LIMIT = 4096
+
+# Сколько последних сообщений диалога подгружать в промпт
+HISTORY_LIMIT = 15
+
+
+def split_telegram_text(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
     """
-    Аналог ваших функций telegramGetFilePath + downloadTelegramFile,
-    но в стиле Python. Возвращает локальный путь к скачанному файлу.
+    Делит длинный текст на части не длиннее limit, по возможности по
+    переносу строки.
     """
-    # Получаем file_path
-    try:
-        file_info = await bot.get_file(file_id)
-    except TelegramBadRequest as e:
-        logging.error(f"Не удалось получить info по file_id={file_id}: {e}")
-        return None
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text.strip() or not parts:
+        parts.append(text)
+    return parts
+
+
+def _stream_preview(text: str) -> str:
+    """
+    Что показывать во время генерации: без (даже недописанного) блока
+    [BUTTONS_JSON] и не длиннее одного сообщения.
+    """
+    marker = text.find("[BUTTONS")
+    if marker != -1:
+        text = text[:marker]
+    text = text.rstrip()
+    if len(text) > TELEGRAM_TEXT_LIMIT - 2:
+        text = text[:TELEGRAM_TEXT_LIMIT - 2] + " …"
+    return text
+
+
+async def stream_reply(
+    placeholder: Message,
+    user_id,
+    rag_chunks: List[dict],
+    history: Optional[List[dict]] = None
+) -> str:
+    """
+    Стримит ответ GPT, редактируя сообщение placeholder по мере генерации.
+    Правки не чаще config.STREAM_EDIT_INTERVAL сек (лимиты Telegram на
+    edit), промежуточный текст — без parse_mode, чтобы недописанная
+    разметка не ломала отправку. Возвращает полный текст ответа.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    next_edit = loop.time() + config.STREAM_FIRST_EDIT_DELAY
+
+    async for delta in stream_gpt_chat_with_history(
+        user_id, HISTORY_LIMIT, rag_chunks=rag_chunks, history=history
+    ):
+        text += delta
+        if loop.time() < next_edit:
+            continue
+
+        preview = _stream_preview(text)
+        if not preview or preview == shown:
+            continue
+        try:
+            await placeholder.edit_text(preview, parse_mode=None)
+            shown = preview
+            next_edit = loop.time() + config.STREAM_EDIT_INTERVAL
+        except TelegramRetryAfter as e:
+            next_edit = loop.time() + e.retry_after
+        except TelegramBadRequest as e:
+            logging.debug(f"Стриминг: правка не прошла: {e}")
+            next_edit = loop.time() + config.STREAM_EDIT_INTERVAL
+
+    return text
+
+
+async def generate_reply(
+    placeholder: Message,
+    user_id,
+    rag_chunks: List[dict],
+    history: Optional[List[dict]] = None
+) -> str:
+    """
+    Ответ GPT: стримингом в placeholder или одним запросом (config.GPT_STREAMING).
+    Фрагменты RAG отбираются в промпт по score в пределах бюджета токенов.
+    """
+    if config.GPT_STREAMING:
+        return await stream_reply(placeholder, user_id, rag_chunks, history)
+    return await get_gpt_chat_with_history(
+        user_id, HISTORY_LIMIT, rag_chunks=rag_chunks, history=history
+    )
 
-    if not file_info.file_path:
-        return None
 
-    # Скачиваем
-    dir_path = os.path.join(os.path.dirname(__file__), "tmp_voices")
-    os.makedirs(dir_path, exist_ok=True)
-    local_filename = os.path.join(dir_path, os.path.basename(file_info.file_path))
+async def finalize_reply(
+    placeholder: Optional[Message],
+    gptReply: str,
+    reply_to: Optional[Message] = None
+):
+    """
+    Финальная версия ответа: убираем [BUTTONS_JSON], **bold** -> *bold*,
+    добавляем инлайн-кнопки. Первая часть заменяет placeholder, остальное
+    (если ответ длиннее лимита) уходит отдельными сообщениями.
+    Без placeholder (готовый ответ) все части отправляются в чат reply_to.
+    Если parse_mode не принял разметку — отправляем как обычный текст.
+    """
+    import re
+    buttonsData = extractButtonsFromGptReply(gptReply)
+    gptReplyClean = re.sub(r"\[BUTTONS_JSON\].*?\[/BUTTONS_JSON\]", "", gptReply, flags=re.DOTALL)
+    gptReplyClean = convertDoubleAsterisksToTelegram(gptReplyClean).strip() or "…"
 
-    await bot.download_file(file_path=file_info.file_path, destination=local_filename)
-    return local_filename
+    inline_keyboard = []
+    for btn in buttonsData:
+        bt_text = btn.get("text")
+        cb = btn.get("callback")
+        if bt_text and cb:
+            inline_keyboard.append([InlineKeyboardButton(text=bt_text, callback_data=cb)])
+    markup = InlineKeyboardMarkup(inline_keyboard=inline_keyboard) if inline_keyboard else None
+
+    parts = split_telegram_text(gptReplyClean)
+    for i, part in enumerate(parts):
+        part_markup = markup if i == len(parts) - 1 else None
+        if placeholder is None:
+            send = reply_to.answer
+        else:
+            send = placeholder.edit_text if i == 0 else placeholder.answer
+        await _send_with_fallback(send, part, part_markup)
+
+
+async def _send_with_fallback(send, text: str, reply_markup, attempts: int = 3):
+    """send(text, ...) с учётом retry_after; при ошибке разметки — без parse_mode."""
+    for parse_mode in dict.fromkeys((config.PARSE_MODE, None)):
+        for _ in range(attempts):
+            try:
+                await send(text, parse_mode=parse_mode, reply_markup=reply_markup)
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    return
+                logging.warning(f"Не удалось отправить ответ с parse_mode={parse_mode}: {e}")
+                break
 
 
 def checkMentionManager(text: str) -> bool:
@@ -131,6 +256,134 @@ def checkMentionManager(text: str) -> bool:
     return config.MANAGER_USERNAME.lower() in text.lower()
 
 
+# ======================
+# Конвейер одного хода диалога
+# ======================
+
+class TurnTimer:
+    """Замеры этапов хода: turn.stage_ms.<этап> и turn.total_ms в metrics."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    async def stage(self, name: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.stages[name] = round(elapsed, 1)
+            metrics.observe(f"turn.stage_ms.{name}", elapsed)
+
+    def finish(self) -> None:
+        total = (time.perf_counter() - self.started) * 1000
+        metrics.observe("turn.total_ms", total)
+        logging.debug(f"Ход диалога: {self.stages}, всего {total:.0f} мс")
+
+
+# Ссылки на фоновые задачи (сохранение, уведомления), чтобы их не собрал GC
+_background_tasks = set()
+
+
+def run_in_background(coro, what: str) -> None:
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            logging.error(f"Фоновая задача '{what}' упала: {e}")
+
+    task = asyncio.create_task(runner())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def load_history(chat_id: int) -> List[dict]:
+    """История чата из кольцевого буфера в памяти (БД — только при первом чтении)."""
+    return await get_history(chat_id, HISTORY_LIMIT)
+
+
+async def persist_turn(
+    chat_id: int,
+    user_id,
+    user_text: str,
+    message_type: str,
+    file_ref: Optional[str],
+    gptReply: str
+):
+    """
+    Сохраняем ход после отправки ответа: вопрос и ответ. Сжатие истории
+    (GPT-сводка старых сообщений) — в фоне: ход уже сохранён, и сбой
+    сжатия не должен выглядеть как ошибка сохранения.
+    """
+    await save_history_message(chat_id, user_id, "user", user_text, message_type, file_ref)
+    await save_history_message(chat_id, user_id, "assistant", gptReply, "text", None)
+    run_in_background(compress_history(chat_id, user_id), "compress_history")
+
+
+def notify_mention(bot, username: str, chat_id: int, text: str, history: List[dict]):
+    """Уведомление менеджера в фоне; контекст — последние сообщения из уже загруженной истории."""
+    if not checkMentionManager(text):
+        return
+    context = "\n".join(f"[{m['role']}] {m['content']}" for m in history[-3:])
+    run_in_background(
+        notify_manager(bot, config.MANAGER_CHAT_ID, username, chat_id, text, context),
+        "notify_manager"
+    )
+
+
+async def answer_turn(
+    bot,
+    placeholder: Message,
+    timer: TurnTimer,
+    chat_id: int,
+    username: str,
+    user_id,
+    history: List[dict],
+    text: str,
+    query_vec: Optional[List[float]] = None,
+    embedded: bool = False,
+    retrieve: bool = True,
+    message_type: str = "text",
+    file_ref: Optional[str] = None
+):
+    """
+    Вторая половина хода (после того как известны пользователь, история
+    и, возможно, эмбеддинг запроса): поиск -> ответ GPT -> отправка ->
+    сохранение. Сохранение идёт уже после ответа пользователю, но внутри
+    хода: следующий ход этого чата (диспетчер держит их по очереди)
+    прочитает историю вместе с ним. Уведомления менеджера — в фоне.
+    embedded=True — эмбеддинг уже считали (query_vec=None значит «не успел»,
+    тогда ищем только по BM25).
+    """
+    turn_history = history + [{"role": "user", "content": text}]
+    notify_mention(bot, username, chat_id, text, history)
+
+    # RAG
+    chunks = []
+    if retrieve:
+        mode = "lexical" if embedded and query_vec is None else None
+        chunks = await timer.stage("retrieval", vectorSearch(text, 3, mode=mode, query_vec=query_vec))
+
+    # GPT
+    gptReply = await timer.stage("completion", generate_reply(placeholder, user_id, chunks, turn_history))
+
+    # Кнопки + финальный текст вместо "⏳ ..."
+    await timer.stage("send", finalize_reply(placeholder, gptReply))
+    timer.finish()
+
+    notify_mention(bot, username, chat_id, gptReply, turn_history)
+    try:
+        await timer.stage("persist", persist_turn(chat_id, user_id, text, message_type, file_ref, gptReply))
+    except Exception as e:
+        logging.error(f"Не удалось сохранить ход диалога user_id={user_id}: {e}")
+
+
+def busy_reply(message: Message):
+    """Вежливый ответ, когда диспетчер не берёт ход (перегрузка)."""
+    return lambda: message.answer(config.BUSY_TEXT)
+
+
 # ======================
 # Хендлер на колбэки (инлайн-кнопки)
 # ======================
@@ -139,66 +392,49 @@ async def handle_callback_query(callback_query: CallbackQuery):
     """
     Аналог блока 1) в PHP: if (isset($updateData["callback_query"])) { ... }
     """
+    # Убираем «загрузка...» сразу, не дожидаясь очереди
+    await callback_query.answer(text="Ок!")  # аналог answerCallbackQuery
+    await turn_dispatcher.run(
+        callback_query.message.chat.id,
+        lambda: callback_turn(callback_query),
+        busy_reply(callback_query.message)
+    )
+
+
+async def callback_turn(callback_query: CallbackQuery):
+    """
+    Ответ на кнопку — из хранилища готовых ответов (callback_answers): он не
+    зависит от истории диалога, поэтому считается один раз на callback_data.
+    В историю нажатие и ответ сохраняются как обычный ход.
+    """
     callback_data = callback_query.data  # строка callback_data
-    callback_id = callback_query.id
     from_chat_id = callback_query.message.chat.id
     from_username = callback_query.from_user.username or ""
+    timer = TurnTimer()
 
-    # Убираем «загрузка...»
-    await callback_query.answer(text="Ок!")  # аналог answerCallbackQuery
-
-    # Определяем / создаём пользователя
-    user = getUserByTelegramId(from_chat_id)
-    if not user:
-        createUser(from_chat_id, from_username)
-        user = getUserByTelegramId(from_chat_id)
-    user_id = user["id"]
-
-    # Сохраняем «user-сообщение» о нажатии
-    user_msg = f"Нажата кнопка (callback_data): {callback_data}"
-    saveChatMessage(user_id, "user", user_msg, "text", None)
+    # Пользователь ∥ готовый ответ (или его вычисление)
+    user_id, gptReply = await asyncio.gather(
+        timer.stage("user", check_and_add_user(from_chat_id, from_username)),
+        timer.stage("callback_answer", callback_answers.get(callback_data))
+    )
+    if gptReply is None:
+        # GPT не ответил — обычный ход с историей (текст ошибки покажет он же)
+        placeholder = await callback_query.message.answer("⏳ ...")
+        history = await timer.stage("history", load_history(from_chat_id))
+        await answer_turn(
+            callback_query.bot, placeholder, timer, from_chat_id, from_username,
+            user_id, history, callback_question(callback_data)
+        )
+        return
 
-    # RAG
-    # chunks = vectorSearch(user_msg, top_k=3)
-    # retrieved = ""
-    # for i, c in enumerate(chunks):
-    #     retrieved += f"\n--- Фрагмент #{i+1}(score={c['score']:.4f})---\n{c['chunk_text']}\n"
+    await timer.stage("send", finalize_reply(None, gptReply, reply_to=callback_query.message))
+    timer.finish()
 
-    # GPT
-    # gptReply = get_gpt_chat_with_history(user_id, 15, system_instructions=f"RAG:\n{retrieved}")
-    gptReply = get_gpt_chat_with_history(user_id, 15, system_instructions=f"RAG:")
-    saveChatMessage(user_id, "assistant", gptReply, "text", None)
-
-    # Проверяем упоминание менеджера
-    if checkMentionManager(gptReply):
-        last_msgs = getLastMessages(user_id, 3)
-        context = ""
-        for m in last_msgs:
-            context += f"[{m['role']}] {m['content']}\n"
-        await notify_manager(callback_query.bot, config.MANAGER_CHAT_ID, from_username, from_chat_id, gptReply, context)
-
-    # Извлекаем кнопки
-    buttonsData = extractButtonsFromGptReply(gptReply)
-    # Удаляем сам блок [BUTTONS_JSON]...[/BUTTONS_JSON] из текста
-    import re
-    gptReplyClean = re.sub(r"\[BUTTONS_JSON\].*?\[/BUTTONS_JSON\]", "", gptReply, flags=re.DOTALL)
-    # Преобразуем **bold** => *bold* для Telegram
-    gptReplyClean = convertDoubleAsterisksToTelegram(gptReplyClean)
-
-    # Формируем Inline Keyboard
-    inline_keyboard = []
-    if buttonsData:
-        for btn in buttonsData:
-            txt = btn.get("text")
-            cb = btn.get("callback")
-            if txt and cb:
-                inline_keyboard.append([InlineKeyboardButton(text=txt, callback_data=cb)])
-
-    # Отправляем ответ
-    await callback_query.message.answer(
-        text=gptReplyClean,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=inline_keyboard) if inline_keyboard else None
-    )
+    notify_mention(callback_query.bot, from_username, from_chat_id, gptReply, await load_history(from_chat_id))
+    try:
+        await persist_turn(from_chat_id, user_id, callback_question(callback_data), "text", None, gptReply)
+    except Exception as e:
+        logging.error(f"Не удалось сохранить ход диалога user_id={user_id}: {e}")
 
 
 # ======================
@@ -209,76 +445,35 @@ async def handle_voice_message(message: Message):
     """
     Аналог обработки voice из PHP-кода
     """
+    await turn_dispatcher.run(message.chat.id, lambda: voice_turn(message), busy_reply(message))
+
+
+async def voice_turn(message: Message):
     bot = message.bot
     chat_id = message.chat.id
     userName = message.from_user.username or ""
+    timer = TurnTimer()
 
-    # Печатаем "typing..."
-    # await message.answer_chat_action(ChatAction.TYPING)
     # Эмулируем "⏳ ..."
-    await message.answer("⏳ ...")
+    placeholder = await message.answer("⏳ ...")
 
-    # Находим / создаём пользователя
-    user = getUserByTelegramId(chat_id)
-    if not user:
-        createUser(chat_id, userName)
-        user = getUserByTelegramId(chat_id)
-    user_id = user["id"]
-
-    # Скачиваем voice
+    # Распознавание (voice в памяти -> Whisper, с кешем) ∥ пользователь ∥ история
     file_id = message.voice.file_id
-    local_path = await download_telegram_voice(bot, file_id)
-    if not local_path:
-        await message.answer("Не удалось скачать voice-файл")
-        return
-
-    # Отправляем в Whisper (as в PHP sendToWhisper($loc))
-    stt_res = send_to_whisper(local_path)
+    stt_res, user_id, history = await asyncio.gather(
+        timer.stage("transcribe", transcribe_voice(
+            bot, file_id, message.voice.file_unique_id, message.voice.duration
+        )),
+        timer.stage("user", check_and_add_user(chat_id, userName)),
+        timer.stage("history", load_history(chat_id))
+    )
     if "error" in stt_res:
-        await message.answer(f"Ошибка распознавания: {stt_res['error']}")
+        await placeholder.edit_text(f"Ошибка распознавания: {stt_res['error']}")
         return
 
-    recText = stt_res.get("text", "")
-    # Сохраняем user-message (voice -> распознанный текст)
-    saveChatMessage(user_id, "user", recText, "voice", local_path)
-
-    # Упоминание менеджера?
-    if checkMentionManager(recText):
-        last_msgs = getLastMessages(user_id, 3)
-        context = "\n".join(f"[{m['role']}] {m['content']}" for m in last_msgs)
-        await notify_manager(bot, config.MANAGER_CHAT_ID, userName, chat_id, recText, context)
-
-    # RAG
-    chunks = vectorSearch(recText, 3)
-    retrieved = ""
-    for i, c in enumerate(chunks):
-        retrieved += f"\n--- Фрагмент #{i+1}(score={c['score']:.4f})---\n{c['chunk_text']}\n"
-
-    # GPT
-    gptReply = get_gpt_chat_with_history(user_id, 15, system_instructions=f"RAG:\n{retrieved}")
-    saveChatMessage(user_id, "assistant", gptReply, "text", None)
-
-    if checkMentionManager(gptReply):
-        last_msgs = getLastMessages(user_id, 3)
-        context = "\n".join(f"[{m['role']}] {m['content']}" for m in last_msgs)
-        await notify_manager(bot, config.MANAGER_CHAT_ID, userName, chat_id, gptReply, context)
-
-    # Кнопки
-    buttonsData = extractButtonsFromGptReply(gptReply)
-    import re
-    gptReplyClean = re.sub(r"\[BUTTONS_JSON\].*?\[/BUTTONS_JSON\]", "", gptReply, flags=re.DOTALL)
-    gptReplyClean = convertDoubleAsterisksToTelegram(gptReplyClean)
-
-    inline_keyboard = []
-    for btn in buttonsData:
-        text = btn.get("text")
-        cb = btn.get("callback")
-        if text and cb:
-            inline_keyboard.append([InlineKeyboardButton(text=text, callback_data=cb)])
-
-    await message.answer(
-        text=gptReplyClean,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=inline_keyboard) if inline_keyboard else None
+    # Вместо пути к файлу сохраняем file_id
+    await answer_turn(
+        bot, placeholder, timer, chat_id, userName, user_id, history,
+        stt_res.get("text", ""), message_type="voice", file_ref=file_id
     )
 
 
@@ -288,60 +483,35 @@ async def handle_voice_message(message: Message):
 @communicator_router.message(F.text)
 async def handle_text_message(message: Message):
     """
-    Аналог обычных текстовых сообщений из PHP:
+    Аналог обычных текстовых сообщений из PHP.
+    Несколько сообщений подряд склеиваются в один ход (text_debouncer):
+    отвечает тот вызов, который открыл пачку, остальные просто выходят.
+    Ходы одного чата идут строго по очереди (turn_dispatcher).
     """
+    batch = await text_debouncer.collect(message.chat.id, message)
+    if batch is None:
+        return
+    text = "\n".join(m.text for m in batch)
+    await turn_dispatcher.run(message.chat.id, lambda: text_turn(message, text), busy_reply(message))
+
+
+async def text_turn(message: Message, text: str):
     bot = message.bot
     chat_id = message.chat.id
-    text = message.text
     userName = message.from_user.username or ""
-    await asyncio.sleep(3)
+    timer = TurnTimer()
 
     "typing..." + "⏳"
-    # await message.answer_chat_action(ChatActions.TYPING)
-    await message.answer("⏳ ...")
-
-    # user
-    user_id = await check_and_add_user(chat_id, userName) 
-
-    # Сохраняем user-сообщение
-    # saveChatMessage(user_id, "user", text, "text", None)
-
-    # Проверяем упоминание менеджера
-    if checkMentionManager(text):
-        last_msgs = getLastMessages(user_id, 3)
-        context = "\n".join(f"[{m['role']}] {m['content']}" for m in last_msgs)
-        await notify_manager(bot, config.MANAGER_CHAT_ID, userName, chat_id, text, context)
+    placeholder = await message.answer("⏳ ...")
 
-    # RAG
-    chunks = vectorSearch(text, 3)
-    retrieved = ""
-    for i, c in enumerate(chunks):
-        retrieved += f"\n--- Фрагмент #{i+1}(score={c['score']:.4f})---\n{c['chunk_text']}\n"
-
-    # GPT
-    gptReply = get_gpt_chat_with_history(user_id, 15, system_instructions=f"RAG:\n{retrieved}")
-    saveChatMessage(user_id, "assistant", gptReply, "text", None)
-
-    # Упоминание менеджера в gptReply?
-    if checkMentionManager(gptReply):
-        last_msgs = getLastMessages(user_id, 3)
-        context = "\n".join(f"[{m['role']}] {m['content']}" for m in last_msgs)
-        await notify_manager(bot, config.MANAGER_CHAT_ID, userName, chat_id, gptReply, context)
-
-    # Кнопки
-    import re
-    buttonsData = extractButtonsFromGptReply(gptReply)
-    gptReplyClean = re.sub(r"\[BUTTONS_JSON\].*?\[/BUTTONS_JSON\]", "", gptReply, flags=re.DOTALL)
-    gptReplyClean = convertDoubleAsterisksToTelegram(gptReplyClean)
-
-    inline_keyboard = []
-    for btn in buttonsData:
-        bt_text = btn.get("text")
-        cb = btn.get("callback")
-        if bt_text and cb:
-            inline_keyboard.append([InlineKeyboardButton(text=bt_text, callback_data=cb)])
+    # Пользователь ∥ эмбеддинг запроса ∥ история
+    user_id, query_vec, history = await asyncio.gather(
+        timer.stage("user", check_and_add_user(chat_id, userName)),
+        timer.stage("embedding", embed_query(text) if config.RAG_SEARCH_MODE != "lexical" else asyncio.sleep(0)),
+        timer.stage("history", load_history(chat_id))
+    )
 
-    await message.answer(
-        text=gptReplyClean,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=inline_keyboard) if inline_keyboard else None
+    await answer_turn(
+        bot, placeholder, timer, chat_id, userName, user_id, history,
+        text, query_vec=query_vec, embedded=True
     )
@@ -1,5 +1,5 @@
 import json
-from typing import Any, Optional
+from typing import Any, Optional, List, Dict
 from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -25,10 +25,159 @@ class Settings(BaseSettings):
     PARSE_MODE: Optional[str] = None
     MANAGER_CHAT_ID: Optional[int] = None
     CURRENT_WELCOME_FILE: str = "currentWelcome.json"
-    TO_DELETE_FILE: str = "toDelete.json"
+    TO_DELETE_FILE: str = "toDelete.json"  # старый формат, переносится в журнал при старте
+    DELETE_JOURNAL_FILE: str = "toDelete.journal"
+    DELETE_BATCH_SLACK: float = 1.0  # удалять вместе всё, что созреет в пределах секунды
     WELCOME_LIFETIME: int = 300
     MANAGER_USERNAME: str = "@Bright099"
 
+    # RAG: "hybrid" | "vector" | "lexical"
+    RAG_SEARCH_MODE: str = "hybrid"
+    RAG_VECTOR_INDEX: str = "exact"  # "exact" | "int8" | "ivf"
+    RAG_EMBED_TIMEOUT: float = 2.0  # сек; дольше — ищем только по BM25
+
+    # Листы Google Sheets, из которых собирается база знаний (doc_chunks)
+    KNOWLEDGE_TABS: List[str] = ["Расписание"]
+    KNOWLEDGE_SYNC_MINUTES: int = 5
+    KNOWLEDGE_CHUNK_CHARS: int = 1500
+
+    # Модерация: сообщения, пришедшие в одно окно, проверяются одним запросом
+    MODERATION_BATCH_WINDOW_MS: int = 200
+    MODERATION_BATCH_MAX: int = 20
+
+    # Локальный тир модерации (до GPT)
+    MODERATION_TRUSTED_USERS: List[int] = []
+    MODERATION_ALLOWED_DOMAINS: List[str] = [
+        "google.com", "goo.gl", "maps.app.goo.gl", "yandex.ru", "2gis.ru",
+        "youtube.com", "youtu.be", "strava.com", "garmin.com",
+    ]
+    MODERATION_DENIED_DOMAINS: List[str] = []
+    MODERATION_SPAM_PATTERNS: List[str] = []
+    MODERATION_SHORT_WORDS: int = 4  # столько слов и меньше — заведомо не спам
+    MODERATION_CONFIRM_CONFIDENCE: float = 0.9
+
+    # Кеш вердиктов модерации; подтверждённый спам хранится на диске
+    MODERATION_CACHE_TTL: int = 3600
+    MODERATION_CACHE_SIZE: int = 10000
+    SPAM_FINGERPRINTS_FILE: str = "spamFingerprints.txt"
+
+    # Стриминг ответов GPT правками одного сообщения
+    GPT_STREAMING: bool = True
+    STREAM_FIRST_EDIT_DELAY: float = 0.3  # сек; первая правка — как только есть текст
+    STREAM_EDIT_INTERVAL: float = 1.0     # сек между правками (лимиты Telegram)
+
+    # Общий HTTP-пул для клиентов OpenAI
+    OPENAI_HTTP2: bool = True
+    OPENAI_MAX_CONNECTIONS: int = 50
+    OPENAI_MAX_KEEPALIVE: int = 20
+    OPENAI_KEEPALIVE_EXPIRY: float = 60.0
+    OPENAI_CONNECT_TIMEOUT: float = 5.0
+    # Таймауты по операциям, сек
+    OPENAI_TIMEOUT_CHAT: float = 60.0
+    OPENAI_TIMEOUT_MODERATION: float = 15.0
+    OPENAI_TIMEOUT_EMBEDDING: float = 10.0
+    OPENAI_TIMEOUT_WHISPER: float = 120.0
+
+    # Планировщик запросов к OpenAI: лимиты по моделям (запросов и токенов
+    # в минуту), длина очереди и дедлайн ожидания (сек) по классам приоритета
+    OPENAI_MODEL_LIMITS: Dict[str, Dict[str, float]] = {
+        "gpt-4o": {"rpm": 500, "tpm": 30000},
+        "gpt-4": {"rpm": 500, "tpm": 10000},
+        "text-embedding-ada-002": {"rpm": 3000, "tpm": 1000000},
+        "gpt-4o-mini": {"rpm": 500, "tpm": 200000},
+        "whisper-1": {"rpm": 50},
+    }
+    OPENAI_QUEUE_LIMITS: Dict[str, int] = {"interactive": 100, "moderation": 200, "background": 20}
+    OPENAI_QUEUE_DEADLINES: Dict[str, float] = {"interactive": 20.0, "moderation": 30.0, "background": 300.0}
+    OPENAI_CHAT_REPLY_TOKENS: int = 800  # оценка длины ответа для бюджета TPM
+    OPENAI_THROTTLE_SECONDS: float = 10.0  # пауза модели после 429 без Retry-After
+
+    # Устойчивость chat.completions: запасные модели, общий дедлайн ответа,
+    # circuit breaker и хеджирование (дубль запроса после p95 задержки)
+    OPENAI_FALLBACK_MODELS: Dict[str, List[str]] = {
+        "gpt-4o": ["gpt-4o-mini"],
+        "gpt-4": ["gpt-4o-mini"],
+        "gpt-4o-mini": ["gpt-4o"],
+    }
+    OPENAI_CHAT_DEADLINE: float = 25.0
+    OPENAI_FALLBACK_RESERVE: float = 6.0  # сек, оставляемые запасной модели
+    OPENAI_BREAKER_FAILURES: int = 5
+    OPENAI_BREAKER_COOLDOWN: float = 30.0
+    OPENAI_HEDGING: bool = True
+    OPENAI_HEDGE_MIN_DELAY: float = 1.0
+    OPENAI_HEDGE_DEFAULT_DELAY: float = 8.0  # пока не набралось замеров для p95
+
+    # Маршрутизация ответов по сложности: тиры моделей и пороги
+    MODEL_TIERS: Dict[str, Dict[str, Any]] = {
+        "fast": {"model": "gpt-4o-mini", "temperature": 0.3},
+        "large": {"model": "gpt-4o", "temperature": 0.7},
+    }
+    ROUTER_THRESHOLDS: Dict[str, float] = {
+        "trivial_query_tokens": 8,       # "привет", "спасибо" — всегда fast
+        "fast_max_query_tokens": 60,     # длиннее — large
+        "fast_min_rag_similarity": 0.8,  # косинус лучшего чанка RAG
+        "large_sticky_turns": 1,         # сколько ответов после large тоже large
+    }
+    MODERATION_TIER: str = "fast"
+    # Цены, $ за 1M токенов — для метрики стоимости по тирам
+    MODEL_PRICES: Dict[str, Dict[str, float]] = {
+        "gpt-4o": {"input": 2.5, "output": 10.0},
+        "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+        "gpt-4": {"input": 30.0, "output": 60.0},
+    }
+
+    # Распознавание голосовых: параллелизм, очередь и кеш расшифровок
+    VOICE_WORKERS: int = 3
+    VOICE_QUEUE_MAX: int = 50
+    VOICE_CACHE_SIZE: int = 1000
+    VOICE_CACHE_TTL: int = 86400
+    # Длинные голосовые: нарезка по паузам (нужен ffmpeg) и параллельный Whisper
+    WHISPER_SEGMENTED: bool = True
+    WHISPER_SEGMENT_MIN_SECONDS: float = 90.0  # короче — одним запросом
+    WHISPER_SEGMENT_SECONDS: float = 45.0
+    WHISPER_SEGMENT_OVERLAP: float = 1.5       # перекрытие при разрезе не по паузе
+    WHISPER_SILENCE_DB: int = -35
+    WHISPER_SILENCE_MIN: float = 0.4
+
+    # Склейка быстрых сообщений чата в один ход (сек)
+    DEBOUNCE_MIN_WINDOW: float = 0.8
+    DEBOUNCE_MAX_WINDOW: float = 3.0
+    DEBOUNCE_MAX_WAIT: float = 6.0      # дольше пачку не держим
+    DEBOUNCE_IDLE_RESET: float = 600.0  # после такой паузы — новый разговор, без задержки
+
+    # Диспетчер ходов диалога: общий лимит одновременных ходов и сброс нагрузки
+    DISPATCH_MAX_CONCURRENT: int = 10
+    DISPATCH_MAX_WAITING: int = 50      # сколько ходов может ждать слот
+    DISPATCH_MAX_WAIT: float = 20.0     # сек ожидания слота
+    DISPATCH_MAX_PER_CHAT: int = 5      # очередь одного чата
+    BUSY_TEXT: str = "Сейчас очень много вопросов 🙏 Напишите, пожалуйста, ещё раз через минуту."
+
+    # История диалогов в памяти: сколько чатов и сообщений на чат держать
+    HISTORY_CACHE_CHATS: int = 5000
+    HISTORY_CACHE_MESSAGES: int = 30
+
+    # Готовые ответы на инлайн-кнопки
+    CALLBACK_CACHE_SIZE: int = 500
+    CALLBACK_PREWARM: List[str] = []   # callback_data, которые греть всегда
+    CALLBACK_PREWARM_TOP: int = 10     # и столько самых частых
+    CALLBACK_PREWARM_MINUTES: int = 5
+
+    # Уведомления менеджера: сводки по типам событий
+    NOTIFY_DIGEST_WINDOW: float = 30.0  # сек; 0 — без сводок
+    NOTIFY_URGENT_KINDS: List[str] = ["mention", "insult"]
+
+    # Приветствие: склейка входов в чат и длина списка имён
+    WELCOME_EDIT_WINDOW: float = 3.0     # сек тишины до правки приветствия
+    WELCOME_EDIT_MAX_WAIT: float = 10.0  # правка не реже, чем раз в столько сек
+    WELCOME_IDLE_RESET: float = 60.0     # после такой паузы первый вход — без ожидания
+    WELCOME_MAX_MENTIONS: int = 20
+
+    # Бюджеты токенов частей промпта для ответов пользователю
+    PROMPT_BUDGET_SYSTEM: int = 1500
+    PROMPT_BUDGET_EXTRA: int = 300
+    PROMPT_BUDGET_RAG: int = 2000
+    PROMPT_BUDGET_HISTORY: int = 2500
+
     SERVICE_ACCOUNT_JSON: Any = None  # Загружается из credentials.json, если не задано явно
 
     model_config = SettingsConfigDict(env_file=".env")
@@ -68,8 +217,37 @@ def load_additional_from_json(settings_obj: Settings, json_path: str = "config.j
 
     for key in [
         "WELCOME_TEXT", "PARSE_MODE", "MANAGER_CHAT_ID",
-        "CURRENT_WELCOME_FILE", "TO_DELETE_FILE", "WELCOME_LIFETIME",
-        "MANAGER_USERNAME", "SERVICE_ACCOUNT_JSON"
+        "CURRENT_WELCOME_FILE", "TO_DELETE_FILE", "DELETE_JOURNAL_FILE",
+        "DELETE_BATCH_SLACK", "WELCOME_LIFETIME",
+        "MANAGER_USERNAME", "SERVICE_ACCOUNT_JSON",
+        "RAG_SEARCH_MODE", "RAG_VECTOR_INDEX", "RAG_EMBED_TIMEOUT",
+        "KNOWLEDGE_TABS", "KNOWLEDGE_SYNC_MINUTES", "KNOWLEDGE_CHUNK_CHARS",
+        "MODERATION_BATCH_WINDOW_MS", "MODERATION_BATCH_MAX",
+        "MODERATION_TRUSTED_USERS", "MODERATION_ALLOWED_DOMAINS",
+        "MODERATION_DENIED_DOMAINS", "MODERATION_SPAM_PATTERNS",
+        "MODERATION_SHORT_WORDS", "MODERATION_CONFIRM_CONFIDENCE",
+        "MODERATION_CACHE_TTL", "MODERATION_CACHE_SIZE", "SPAM_FINGERPRINTS_FILE",
+        "GPT_STREAMING", "STREAM_FIRST_EDIT_DELAY", "STREAM_EDIT_INTERVAL",
+        "OPENAI_HTTP2", "OPENAI_MAX_CONNECTIONS", "OPENAI_MAX_KEEPALIVE",
+        "OPENAI_KEEPALIVE_EXPIRY", "OPENAI_CONNECT_TIMEOUT", "OPENAI_TIMEOUT_CHAT",
+        "OPENAI_TIMEOUT_MODERATION", "OPENAI_TIMEOUT_EMBEDDING", "OPENAI_TIMEOUT_WHISPER",
+        "OPENAI_MODEL_LIMITS", "OPENAI_QUEUE_LIMITS", "OPENAI_QUEUE_DEADLINES",
+        "OPENAI_CHAT_REPLY_TOKENS", "OPENAI_THROTTLE_SECONDS",
+        "PROMPT_BUDGET_SYSTEM", "PROMPT_BUDGET_EXTRA", "PROMPT_BUDGET_RAG",
+        "PROMPT_BUDGET_HISTORY", "OPENAI_FALLBACK_MODELS", "OPENAI_CHAT_DEADLINE",
+        "OPENAI_FALLBACK_RESERVE", "OPENAI_BREAKER_FAILURES", "OPENAI_BREAKER_COOLDOWN",
+        "OPENAI_HEDGING", "OPENAI_HEDGE_MIN_DELAY", "OPENAI_HEDGE_DEFAULT_DELAY",
+        "MODEL_TIERS", "ROUTER_THRESHOLDS", "MODERATION_TIER", "MODEL_PRICES",
+        "VOICE_WORKERS", "VOICE_QUEUE_MAX", "VOICE_CACHE_SIZE", "VOICE_CACHE_TTL",
+        "WHISPER_SEGMENTED", "WHISPER_SEGMENT_MIN_SECONDS", "WHISPER_SEGMENT_SECONDS",
+        "WHISPER_SEGMENT_OVERLAP", "WHISPER_SILENCE_DB", "WHISPER_SILENCE_MIN",
+        "DEBOUNCE_MIN_WINDOW", "DEBOUNCE_MAX_WINDOW", "DEBOUNCE_MAX_WAIT",
+        "DEBOUNCE_IDLE_RESET", "DISPATCH_MAX_CONCURRENT", "DISPATCH_MAX_WAITING",
+        "DISPATCH_MAX_WAIT", "DISPATCH_MAX_PER_CHAT", "BUSY_TEXT",
+        "HISTORY_CACHE_CHATS", "HISTORY_CACHE_MESSAGES", "CALLBACK_CACHE_SIZE",
+        "CALLBACK_PREWARM", "CALLBACK_PREWARM_TOP", "CALLBACK_PREWARM_MINUTES",
+        "NOTIFY_DIGEST_WINDOW", "NOTIFY_URGENT_KINDS", "WELCOME_EDIT_WINDOW",
+        "WELCOME_EDIT_MAX_WAIT", "WELCOME_IDLE_RESET", "WELCOME_MAX_MENTIONS"
     ]:
         if key in data:
             setattr(settings_obj, key, data[key])
@@ -1,16 +1,153 @@
+import asyncio
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from cachetools import TTLCache, LRUCache
+
+from config import config
+from metrics import metrics
 from db import (
-    getUserByTelegramId,
-    createUser,
-    saveChatMessage,
-    getLastMessages
+    get_user_by_telegram_id,
+    create_user,
+    save_chat_message,
+    get_last_messages_by_telegram_id,
+    compress_old_messages
 )
+from openai_module import summarize_history
 
 
+# telegram_id -> users.id: id пользователя не меняется, в БД ходим один раз
+_user_ids: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+
 
 async def check_and_add_user(chat_id, username):
-    # user  = getUserByTelegramId(chat_id)
-    # if not user:
-    #     createUser(chat_id, username)
-    #     user = getUserByTelegramId(chat_id)
-    # return user["id"]
-    return "113231"
\ No newline at end of file
+    """Находит пользователя по telegram_id или создаёт demo-пользователя; возвращает users.id."""
+    user_id = _user_ids.get(chat_id)
+    if user_id is not None:
+        return user_id
+
+    user = await get_user_by_telegram_id(chat_id)
+    user_id = user["id"] if user else await create_user(chat_id, username)
+    _user_ids[chat_id] = user_id
+    return user_id
+
+
+# =============================================================================
+# История диалога: кольцевые буферы в памяти, БД — журнал
+# =============================================================================
+
+class ConversationCache:
+    """
+    LRU (не больше max_chats чатов) из deque последних max_messages
+    сообщений чата. Буфер заполняется из БД при первом чтении, дальше
+    каждое сохранение пишет в БД и дописывает в буфер (write-through),
+    так что чтения истории в БД не ходят.
+    """
+
+    def __init__(self, max_chats: int, max_messages: int):
+        self.max_messages = max_messages
+        self._buffers: LRUCache = LRUCache(maxsize=max_chats)
+        self._loading: Dict[int, asyncio.Future] = {}
+
+    async def _buffer(self, chat_id: int) -> deque:
+        buffer = self._buffers.get(chat_id)
+        if buffer is not None:
+            metrics.inc("history_cache.hit")
+            return buffer
+
+        # Одновременные первые чтения одного чата грузят историю один раз
+        pending = self._loading.get(chat_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        metrics.inc("history_cache.miss")
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            rows = await get_last_messages_by_telegram_id(chat_id, self.max_messages)
+            buffer = deque(rows, maxlen=self.max_messages)
+            self._buffers[chat_id] = buffer
+            future.set_result(buffer)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(chat_id, None)
+        return buffer
+
+    async def get(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Последние limit сообщений чата в хронологическом порядке (копии)."""
+        buffer = await self._buffer(chat_id)
+        return [dict(m) for m in list(buffer)[-limit:]]
+
+    async def append(
+        self,
+        chat_id: int,
+        user_id,
+        role: str,
+        content: str,
+        message_type: str = "text",
+        file_path: Optional[str] = None
+    ) -> int:
+        message_id = await save_chat_message(user_id, role, content, message_type, file_path)
+        buffer = self._buffers.get(chat_id)
+        if buffer is not None:
+            buffer.append({
+                "id": message_id,
+                "user_id": user_id,
+                "role": role,
+                "content": content,
+                "message_type": message_type,
+                "file_path": file_path,
+            })
+        return message_id
+
+    def invalidate(self, chat_id: int) -> None:
+        self._buffers.pop(chat_id, None)
+
+
+conversation_cache = ConversationCache(
+    max_chats=config.HISTORY_CACHE_CHATS,
+    max_messages=config.HISTORY_CACHE_MESSAGES
+)
+
+
+async def get_history(chat_id: int, limit: int) -> List[Dict[str, Any]]:
+    return await conversation_cache.get(chat_id, limit)
+
+
+async def save_history_message(
+    chat_id: int,
+    user_id,
+    role: str,
+    content: str,
+    message_type: str = "text",
+    file_path: Optional[str] = None
+) -> int:
+    return await conversation_cache.append(chat_id, user_id, role, content, message_type, file_path)
+
+
+# Пользователи, чья история сжимается прямо сейчас: два фоновых сжатия
+# подряд иначе суммировали бы одни и те же сообщения дважды
+_compressing: set = set()
+
+
+async def compress_history(chat_id: int, user_id) -> bool:
+    """
+    Сжатие старых сообщений в БД (GPT-сводка вместо 10 старейших).
+    Буфер чата сбрасывается только если сводка действительно записана:
+    без неё (мало сообщений, GPT не ответил) история в БД не менялась,
+    и буфер остаётся верным. Возвращает True, если история переписана.
+    """
+    if user_id in _compressing:
+        return False
+    _compressing.add(user_id)
+    try:
+        compressed = await compress_old_messages(user_id, summarize_history)
+    finally:
+        _compressing.discard(user_id)
+    if compressed:
+        metrics.inc("history_cache.compressed")
+        conversation_cache.invalidate(chat_id)
+    return compressed
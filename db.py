@@ -1,6 +1,6 @@
 import os
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable
 import json
 
 # SQLAlchemy imports
@@ -253,6 +253,71 @@ async def get_all_doc_chunks() -> List[Dict[str, Any]]:
         return [dict(r._mapping) for r in rows]
 
 
+# Chunks synced from external sources (see knowledge_sync.py) carry two
+# extra columns:
+#   ALTER TABLE doc_chunks
+#     ADD COLUMN source VARCHAR(255) NULL,
+#     ADD COLUMN content_hash CHAR(64) NULL,
+#     ADD INDEX idx_doc_chunks_source (source);
+async def get_doc_chunk_hashes(source_prefix: str) -> List[Dict[str, Any]]:
+    """
+    SELECT id, source, content_hash FROM doc_chunks WHERE source LIKE 'prefix%'
+    Return list of dicts (no embeddings, so it stays cheap)
+    """
+    query = text("""
+        SELECT id, source, content_hash
+          FROM doc_chunks
+         WHERE source LIKE :prefix
+    """)
+    async with engine.connect() as conn:
+        result = await conn.execute(query, {"prefix": f"{source_prefix}%"})
+        rows = result.fetchall()
+        return [dict(r._mapping) for r in rows]
+
+
+async def insert_hashed_doc_chunks(chunks: List[Dict[str, Any]]) -> List[int]:
+    """
+    INSERT INTO doc_chunks (chunk_text, embedding, source, content_hash)
+    One transaction for the whole batch.
+    Each item: {"chunk_text", "embedding_json", "source", "content_hash"}
+    Return inserted row IDs in the same order
+    """
+    if not chunks:
+        return []
+
+    query = text("""
+        INSERT INTO doc_chunks (chunk_text, embedding, source, content_hash)
+        VALUES (:chunk, :emb, :src, :hash)
+    """)
+    inserted_ids = []
+    async with engine.begin() as conn:
+        for c in chunks:
+            result = await conn.execute(
+                query,
+                {
+                    "chunk": c["chunk_text"],
+                    "emb": c["embedding_json"],
+                    "src": c["source"],
+                    "hash": c["content_hash"]
+                }
+            )
+            inserted_ids.append(result.lastrowid)
+    return inserted_ids
+
+
+async def delete_doc_chunks_by_ids(ids: List[int]) -> None:
+    """
+    DELETE FROM doc_chunks WHERE id IN (:inlist)
+    """
+    if not ids:
+        return
+
+    placeholders = ", ".join(str(int(x)) for x in ids)
+    query_text = f"DELETE FROM doc_chunks WHERE id IN ({placeholders})"
+    async with engine.begin() as conn:
+        await conn.execute(text(query_text))
+
+
 # ------------------------------------------------------------------------
 # 4) CHAT_HISTORY block
 # ------------------------------------------------------------------------
@@ -314,6 +379,29 @@ async def get_last_messages(user_id: int, limit: int = 10) -> List[Dict[str, Any
     return [dict(r._mapping) for r in reversed_rows]
 
 
+async def get_last_messages_by_telegram_id(telegram_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Same as get_last_messages, but looked up by users.telegram_id, so the
+    history can be loaded before (and in parallel with) resolving the user.
+    Unknown telegram_id -> empty list.
+    """
+    query = text("""
+        SELECT ch.*
+          FROM chat_history ch
+          JOIN users u ON u.id = ch.user_id
+         WHERE u.telegram_id = :tg
+         ORDER BY ch.id DESC
+         LIMIT :lim
+    """)
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            query.bindparams(tg=telegram_id, lim=limit)
+        )
+        rows = result.fetchall()
+
+    return [dict(r._mapping) for r in reversed(rows)]
+
+
 async def get_all_messages_count(user_id: int) -> int:
     """
     SELECT COUNT(*) as cnt FROM chat_history WHERE user_id = :uid
@@ -325,8 +413,7 @@ async def get_all_messages_count(user_id: int) -> int:
     """)
     async with engine.connect() as conn:
         result = await conn.execute(query, {"uid": user_id})
-        row = result.fetchone()
-        return int(row['cnt'] if row else 0)
+        return int(result.scalar() or 0)
 
 
 async def get_old_messages_for_summary(user_id: int, count: int = 10) -> List[Dict[str, Any]]:
@@ -363,26 +450,48 @@ async def delete_messages_by_ids(ids: List[int]) -> None:
         await conn.execute(text(query_text))
 
 
-async def compress_old_messages(user_id: int) -> None:
+async def replace_messages_with_summary(ids: List[int], summary: str) -> None:
     """
-    Example "summary" approach: If total msg count > 20, 
-    get first 10, summarize them, then delete those 10, then
-    save the summary as one message.
+    In one transaction: the oldest of ids becomes the summary (so it keeps
+    its chronological place at the start of the history), the rest are deleted.
+    """
+    first, rest = min(ids), [x for x in ids if x != min(ids)]
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("""
+                UPDATE chat_history
+                   SET role = 'assistant', content = :ct, message_type = 'text', file_path = NULL
+                 WHERE id = :id
+            """),
+            {"ct": summary, "id": first}
+        )
+        if rest:
+            placeholders = ", ".join(str(int(x)) for x in rest)
+            await conn.execute(text(f"DELETE FROM chat_history WHERE id IN ({placeholders})"))
+
+
+async def compress_old_messages(
+    user_id: int,
+    summarize: Callable[[List[Dict[str, Any]]], Awaitable[Optional[str]]]
+) -> bool:
+    """
+    If total msg count > 20: summarize the oldest 10 with summarize(...)
+    (e.g. openai_module.summarize_history) and replace them with that
+    single summary message.
+    Nothing is deleted unless a real summary was produced.
+    Returns True if the history was rewritten (callers caching it must reload).
     """
     total_count = await get_all_messages_count(user_id)
     if total_count <= 20:
-        return
+        return False
 
     old_msgs = await get_old_messages_for_summary(user_id, 10)
     if len(old_msgs) < 10:
-        return
-
-    # create summary
-    summary = f"(Summary of {total_count} messages...)"  # or call GPT to do it for real
+        return False
 
-    msg_ids = [m['id'] for m in old_msgs]
-    # Delete old ones
-    await delete_messages_by_ids(msg_ids)
+    summary = await summarize(old_msgs)
+    if not summary:
+        return False
 
-    # Insert the summary as a single chat message
-    await save_chat_message(user_id, 'assistant', summary, 'text', None)
+    await replace_messages_with_summary([m['id'] for m in old_msgs], summary)
+    return True
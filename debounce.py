@@ -0,0 +1,103 @@
+import asyncio
+from typing import Any, List, Optional
+
+from cachetools import TTLCache
+
+from config import config
+from metrics import metrics
+
+
+# =============================================================================
+# Склейка быстрых сообщений одного чата в один ход
+# =============================================================================
+
+class _ChatState:
+    __slots__ = ("last_at", "gap", "pending", "future", "timer", "opened_at")
+
+    def __init__(self, now: float):
+        self.last_at = now
+        self.gap: Optional[float] = None  # сглаженный интервал между сообщениями пачки
+        self.pending: Optional[List[Any]] = None
+        self.future: Optional[asyncio.Future] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.opened_at = now
+
+
+class MessageDebouncer:
+    """
+    Собирает сообщения чата, идущие друг за другом, в одну пачку: пачка
+    закрывается, когда чат «замолчал» на окно тишины (или пачка ждёт
+    дольше max_wait). Окно подстраивается под темп чата: 1.5 × сглаженный
+    интервал между его сообщениями, в пределах [min_window, max_window].
+    Первое сообщение разговора (чат молчал дольше idle_reset) не ждёт вовсе.
+
+    collect() возвращает список сообщений тому вызову, который открыл
+    пачку, и None остальным — их сообщения уже вошли в чужой ход.
+    """
+
+    def __init__(self, min_window: float, max_window: float, max_wait: float, idle_reset: float):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_wait = max_wait
+        # Чаты, молчащие дольше idle_reset, выпадают сами — следующее
+        # сообщение снова считается началом разговора
+        self._chats: TTLCache = TTLCache(maxsize=100000, ttl=idle_reset)
+
+    def window(self, state: _ChatState) -> float:
+        if state.gap is None:
+            return self.min_window
+        return min(self.max_window, max(self.min_window, state.gap * 1.5))
+
+    async def collect(self, chat_id: int, item: Any) -> Optional[List[Any]]:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        state = self._chats.get(chat_id)
+
+        if state is None:
+            # Начало разговора — отвечаем сразу
+            self._chats[chat_id] = _ChatState(now)
+            metrics.observe("debounce.batch_size", 1)
+            return [item]
+
+        gap = now - state.last_at
+        state.last_at = now
+        if gap <= self.max_window:
+            state.gap = gap if state.gap is None else 0.7 * state.gap + 0.3 * gap
+        self._chats[chat_id] = state  # продлеваем TTL
+
+        if state.pending is not None:
+            # Пачка уже собирается — добавляем и сдвигаем окно
+            state.pending.append(item)
+            metrics.inc("debounce.merged")
+            self._schedule(state, loop)
+            return None
+
+        state.pending = [item]
+        state.future = loop.create_future()
+        state.opened_at = now
+        self._schedule(state, loop)
+        return await state.future
+
+    def _schedule(self, state: _ChatState, loop: asyncio.AbstractEventLoop) -> None:
+        if state.timer is not None:
+            state.timer.cancel()
+        window = self.window(state)
+        fire_at = min(loop.time() + window, state.opened_at + self.max_wait)
+        state.timer = loop.call_at(fire_at, self._flush, state)
+        metrics.observe("debounce.window_ms", window * 1000)
+
+    @staticmethod
+    def _flush(state: _ChatState) -> None:
+        batch, future = state.pending, state.future
+        state.pending, state.future, state.timer = None, None, None
+        metrics.observe("debounce.batch_size", len(batch))
+        if not future.done():
+            future.set_result(batch)
+
+
+text_debouncer = MessageDebouncer(
+    min_window=config.DEBOUNCE_MIN_WINDOW,
+    max_window=config.DEBOUNCE_MAX_WINDOW,
+    max_wait=config.DEBOUNCE_MAX_WAIT,
+    idle_reset=config.DEBOUNCE_IDLE_RESET
+)
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiofiles
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from config import config
+from metrics import metrics
+
+
+# Telegram удаляет не больше 100 сообщений одного чата за вызов
+DELETE_BATCH_LIMIT = 100
+# Временные сбои (сеть, 5xx): через сколько секунд и сколько раз повторять
+DELETE_RETRY_DELAY = 30.0
+DELETE_MAX_ATTEMPTS = 3
+
+
+# =============================================================================
+# Отложенное удаление сообщений: куча в памяти + журнал на диске
+# =============================================================================
+
+class DeletionScheduler:
+    """
+    Сообщения на удаление лежат в min-куче (delete_after, chat_id,
+    message_id); таймер (loop.call_at) заведён на ближайший срок. Всё,
+    что созрело к его срабатыванию (с запасом batch_slack секунд), удаляется
+    пачками delete_messages по чатам.
+
+    Каждое планирование и каждое удаление дописывается строкой в журнал
+    (append-only, JSON lines) — файл целиком не переписывается. После
+    перезапуска start() проигрывает журнал: запланированные, но не
+    удалённые сообщения возвращаются в кучу. Журнал сжимается один раз
+    при старте, если в нём в основном отработанные записи.
+    """
+
+    def __init__(self, journal_path: str, batch_slack: float):
+        self.journal_path = journal_path
+        self.batch_slack = batch_slack
+        self._heap: List[Tuple[float, int, int]] = []
+        self._bot = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: Optional[float] = None
+        self._running: Optional[asyncio.Task] = None
+        self._journal: List[dict] = []
+        self._writer: Optional[asyncio.Task] = None
+        self._attempts: Dict[Tuple[int, int], int] = {}
+
+    # -------------------------------------------------------------------------
+    # Планирование
+    # -------------------------------------------------------------------------
+
+    def schedule(self, chat_id: int, message_id: int, delay: float) -> None:
+        delete_after = time.time() + delay
+        heapq.heappush(self._heap, (delete_after, chat_id, message_id))
+        self._log({"op": "add", "chat_id": chat_id, "message_id": message_id, "delete_after": delete_after})
+        metrics.gauge("deletion.pending", len(self._heap))
+        self._arm()
+
+    def _arm(self) -> None:
+        """Таймер на ближайший срок (если он раньше уже заведённого)."""
+        if self._bot is None or not self._heap:
+            return
+        if self._running is not None and not self._running.done():
+            return  # _run_due сам перезаведёт таймер по окончании
+        due = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_at is not None and self._timer_at <= due:
+                return
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer_at = due
+        self._timer = loop.call_at(loop.time() + max(0.0, due - time.time()), self._fire)
+
+    def _fire(self) -> None:
+        self._timer, self._timer_at = None, None
+        self._running = asyncio.create_task(self._run_due())
+
+    async def _run_due(self) -> None:
+        try:
+            while self._heap and self._heap[0][0] <= time.time() + self.batch_slack:
+                by_chat: Dict[int, List[int]] = defaultdict(list)
+                while self._heap and self._heap[0][0] <= time.time() + self.batch_slack:
+                    _, chat_id, message_id = heapq.heappop(self._heap)
+                    by_chat[chat_id].append(message_id)
+                metrics.gauge("deletion.pending", len(self._heap))
+                for chat_id, message_ids in by_chat.items():
+                    for i in range(0, len(message_ids), DELETE_BATCH_LIMIT):
+                        await self._delete(chat_id, message_ids[i:i + DELETE_BATCH_LIMIT])
+        finally:
+            self._running = None
+            if self._heap:
+                self._arm()
+
+    async def _delete(self, chat_id: int, message_ids: List[int]) -> None:
+        """
+        Удаляет пачку одного чата. Любая ошибка остаётся внутри: пачки
+        других чатов удаляются дальше. Временные сбои (сеть, 5xx, чужие
+        исключения) возвращают пачку в кучу через DELETE_RETRY_DELAY сек,
+        не больше DELETE_MAX_ATTEMPTS раз; постоянные (сообщение уже
+        удалено, бота исключили из чата) закрывают записи в журнале.
+        """
+        for attempt in range(2):
+            try:
+                if len(message_ids) == 1:
+                    await self._bot.delete_message(chat_id, message_ids[0])
+                else:
+                    await self._bot.delete_messages(chat_id, message_ids)
+                metrics.inc("deletion.deleted", len(message_ids))
+                metrics.inc("deletion.calls")
+                break
+            except TelegramRetryAfter as e:
+                metrics.inc("deletion.retry_after")
+                if attempt:
+                    self._retry_later(chat_id, message_ids, e)
+                    return
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                self._retry_later(chat_id, message_ids, e)
+                return
+            except TelegramAPIError as e:
+                # Уже удалено, слишком старое, нет прав/доступа к чату —
+                # повторять бессмысленно
+                metrics.inc("deletion.failed")
+                logging.error(f"Ошибка удаления сообщений {message_ids} в чате {chat_id}: {e}")
+                break
+            except Exception as e:
+                self._retry_later(chat_id, message_ids, e)
+                return
+        self._finish(chat_id, message_ids)
+
+    def _retry_later(self, chat_id: int, message_ids: List[int], error: BaseException) -> None:
+        retry_at = time.time() + DELETE_RETRY_DELAY
+        gave_up = []
+        for message_id in message_ids:
+            key = (chat_id, message_id)
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts >= DELETE_MAX_ATTEMPTS:
+                gave_up.append(message_id)
+                continue
+            self._attempts[key] = attempts
+            heapq.heappush(self._heap, (retry_at, chat_id, message_id))
+        metrics.gauge("deletion.pending", len(self._heap))
+        if gave_up:
+            metrics.inc("deletion.failed", len(gave_up))
+            logging.error(f"Не удалось удалить сообщения {gave_up} в чате {chat_id}: {error!r}")
+            self._finish(chat_id, gave_up)
+        if len(gave_up) < len(message_ids):
+            metrics.inc("deletion.retried")
+            logging.warning(f"Удаление сообщений в чате {chat_id} отложено: {error!r}")
+
+    def _finish(self, chat_id: int, message_ids: List[int]) -> None:
+        for message_id in message_ids:
+            self._attempts.pop((chat_id, message_id), None)
+            self._log({"op": "done", "chat_id": chat_id, "message_id": message_id})
+
+    # -------------------------------------------------------------------------
+    # Журнал
+    # -------------------------------------------------------------------------
+
+    def _log(self, record: dict) -> None:
+        self._journal.append(record)
+        if self._bot is None:
+            # До конца start() файл не трогаем: его проигрывают и, возможно,
+            # подменяют сжатой копией — запись ляжет в файл после этого
+            return
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_journal())
+
+    async def _write_journal(self) -> None:
+        while self._journal:
+            records, self._journal = self._journal, []
+            try:
+                async with aiofiles.open(self.journal_path, "a", encoding="utf-8") as f:
+                    await f.write("".join(json.dumps(r) + "\n" for r in records))
+            except Exception as e:
+                logging.error(f"Не удалось дописать журнал {self.journal_path}: {e}")
+                return
+
+    async def _replay(self) -> List[Tuple[float, int, int]]:
+        if not os.path.exists(self.journal_path):
+            return []
+        added: Dict[Tuple[int, int], float] = {}
+        done: Set[Tuple[int, int]] = set()
+        records = 0
+        async with aiofiles.open(self.journal_path, "r", encoding="utf-8") as f:
+            async for line in f:
+                try:
+                    r = json.loads(line)
+                    key = (int(r["chat_id"]), int(r["message_id"]))
+                except (ValueError, KeyError, TypeError):
+                    continue  # недописанная при сбое строка
+                records += 1
+                if r.get("op") == "add":
+                    added[key] = float(r["delete_after"])
+                    done.discard(key)
+                elif r.get("op") == "done":
+                    done.add(key)
+        pending = [(at, chat_id, message_id) for (chat_id, message_id), at in added.items()
+                   if (chat_id, message_id) not in done]
+        if records > 2 * len(pending) + 100:
+            await self._compact(pending)
+        return pending
+
+    async def _compact(self, pending: List[Tuple[float, int, int]]) -> None:
+        tmp_path = f"{self.journal_path}.tmp"
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            await f.write("".join(
+                json.dumps({"op": "add", "chat_id": c, "message_id": m, "delete_after": at}) + "\n"
+                for at, c, m in pending
+            ))
+        os.replace(tmp_path, self.journal_path)
+
+    async def _import_legacy(self, path: str) -> None:
+        """Переносим записи из старого toDelete.json (один раз)."""
+        if not path or not os.path.exists(path):
+            return
+        try:
+            async with aiofiles.open(path, "r", encoding="utf-8") as f:
+                raw = await f.read()
+            data = json.loads(raw) if raw.strip() else []
+        except Exception as e:
+            logging.error(f"Не смогли прочитать {path}: {e}")
+            return
+        now = time.time()
+        for entry in data if isinstance(data, list) else []:
+            try:
+                self.schedule(int(entry["chat_id"]), int(entry["message_id"]),
+                              float(entry["delete_after"]) - now)
+            except (ValueError, KeyError, TypeError):
+                continue
+        os.replace(path, f"{path}.migrated")
+
+    # -------------------------------------------------------------------------
+    # Запуск и остановка
+    # -------------------------------------------------------------------------
+
+    async def start(self, bot) -> None:
+        """
+        Восстанавливаем очередь из журнала и заводим таймер (вызывается из
+        main). Бот назначается только после проигрывания и сжатия журнала:
+        до этого schedule() копит записи в памяти, и подмена файла их не
+        теряет.
+        """
+        try:
+            pending = await self._replay()
+        except Exception as e:
+            logging.error(f"Не смогли прочитать журнал {self.journal_path}: {e}")
+            pending = []
+        for entry in pending:
+            heapq.heappush(self._heap, entry)
+        await self._import_legacy(config.TO_DELETE_FILE)
+        self._bot = bot
+        if self._journal:
+            self._writer = asyncio.create_task(self._write_journal())
+        metrics.gauge("deletion.pending", len(self._heap))
+        if pending:
+            logging.info(f"Восстановлено {len(pending)} отложенных удалений")
+        self._arm()
+
+    async def close(self) -> None:
+        """Дописать журнал (при остановке бота)."""
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._writer is not None and not self._writer.done():
+            await self._writer
+        await self._write_journal()
+
+
+deletion_scheduler = DeletionScheduler(
+    journal_path=config.DELETE_JOURNAL_FILE,
+    batch_slack=config.DELETE_BATCH_SLACK
+)
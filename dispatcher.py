@@ -0,0 +1,106 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+from config import config
+from metrics import metrics
+
+
+# =============================================================================
+# Диспетчер ходов диалога: порядок внутри чата, общий лимит, сброс нагрузки
+# =============================================================================
+
+class _ChatQueue:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # очередь ожидающих у asyncio.Lock — FIFO
+        self.depth = 0
+
+
+class TurnDispatcher:
+    """
+    Ходы одного чата выполняются строго по очереди (FIFO), разных чатов —
+    параллельно, но не больше max_concurrent одновременно. Ход отклоняется
+    (вызывается on_busy — вежливый ответ «сейчас занято»), если:
+      - в очереди этого чата уже max_per_chat ходов;
+      - общий лимит занят и за слот уже ждут max_waiting ходов;
+      - слот не освободился за max_wait секунд.
+    """
+
+    def __init__(self, max_concurrent: int, max_waiting: int, max_wait: float, max_per_chat: int):
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.max_per_chat = max_per_chat
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._waiting = 0
+        self._active = 0
+
+    def _export(self) -> None:
+        metrics.gauge("dispatcher.active", self._active)
+        metrics.gauge("dispatcher.waiting", self._waiting)
+        metrics.gauge("dispatcher.queued", sum(q.depth for q in self._chats.values()))
+
+    async def _shed(self, reason: str, on_busy: Callable[[], Awaitable]) -> None:
+        metrics.inc(f"dispatcher.shed.{reason}")
+        logging.warning(f"Диспетчер: ход отклонён ({reason})")
+        try:
+            await on_busy()
+        except Exception as e:
+            logging.error(f"Не удалось отправить ответ «занято»: {e}")
+
+    async def run(
+        self,
+        chat_id: int,
+        turn: Callable[[], Awaitable],
+        on_busy: Callable[[], Awaitable]
+    ) -> None:
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = _ChatQueue()
+        if queue.depth >= self.max_per_chat:
+            await self._shed("chat_queue", on_busy)
+            return
+
+        queue.depth += 1
+        self._export()
+        enqueued_at = time.monotonic()
+        try:
+            async with queue.lock:
+                if self._slots.locked() and self._waiting >= self.max_waiting:
+                    await self._shed("overloaded", on_busy)
+                    return
+
+                self._waiting += 1
+                self._export()
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), self.max_wait)
+                except asyncio.TimeoutError:
+                    await self._shed("timeout", on_busy)
+                    return
+                finally:
+                    self._waiting -= 1
+
+                metrics.observe("dispatcher.wait_ms", (time.monotonic() - enqueued_at) * 1000)
+                self._active += 1
+                self._export()
+                try:
+                    await turn()
+                finally:
+                    self._active -= 1
+                    self._slots.release()
+        finally:
+            queue.depth -= 1
+            if queue.depth == 0:
+                self._chats.pop(chat_id, None)
+            self._export()
+
+
+turn_dispatcher = TurnDispatcher(
+    max_concurrent=config.DISPATCH_MAX_CONCURRENT,
+    max_waiting=config.DISPATCH_MAX_WAITING,
+    max_wait=config.DISPATCH_MAX_WAIT,
+    max_per_chat=config.DISPATCH_MAX_PER_CHAT
+)
@@ -231,3 +231,30 @@ def mark_message_as_spam(message_id: str):
         logging.debug("DEBUG: markMessageAsSpam => messageId=%s not found in 'Messages'", message_id)
     except HttpError as e:
         logging.error("EXCEPTION in markMessageAsSpam: %s", e)
+
+
+def get_sheet_values(sheet_name: str) -> Optional[list]:
+    """
+    Читает все значения листа sheet_name (строки как списки ячеек).
+    Возвращает None при ошибке, [] — если лист пуст.
+    """
+    logging.debug("DEBUG: getSheetValues(%s) called.", sheet_name)
+
+    service = get_sheets_service()
+    if not service:
+        logging.error("ERROR: Sheets service is null, aborting getSheetValues.")
+        return None
+
+    # Имя листа в кавычках — на случай пробелов и кириллицы
+    range_name = "'" + sheet_name.replace("'", "''") + "'"
+    try:
+        response = service.spreadsheets().values().get(
+            spreadsheetId=config.GOOGLE_SHEET_ID,
+            range=range_name
+        ).execute()
+        values = response.get("values", [])
+        logging.debug("DEBUG: getSheetValues => %d rows in '%s'", len(values), sheet_name)
+        return values
+    except HttpError as e:
+        logging.error("EXCEPTION in getSheetValues: %s", e)
+        return None
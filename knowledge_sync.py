@@ -0,0 +1,155 @@
+import json
+import asyncio
+import hashlib
+import logging
+from typing import List, Dict, Optional
+
+from config import config
+from db import (
+    get_doc_chunk_hashes,
+    insert_hashed_doc_chunks,
+    delete_doc_chunks_by_ids
+)
+from google_sheets import get_sheet_values
+from openai_module import get_embeddings
+import vector_search
+
+
+# Источник чанков в doc_chunks.source: "sheet:<имя листа>"
+SOURCE_PREFIX = "sheet:"
+
+_sync_lock = asyncio.Lock()
+
+
+# =============================================================================
+# Разбиение листа на чанки
+# =============================================================================
+
+def _split_long(text: str, limit: int) -> List[str]:
+    """Режет длинный текст по строкам/пробелам на куски не длиннее limit."""
+    if len(text) <= limit:
+        return [text]
+    parts, current = [], ""
+    for piece in text.replace("; ", ";\n").splitlines(keepends=True):
+        if current and len(current) + len(piece) > limit:
+            parts.append(current)
+            current = ""
+        # Строка длиннее limit — режем её саму: по пробелу, а если его
+        # нет — жёстко по limit
+        while len(piece) > limit:
+            cut = piece.rfind(" ", 0, limit)
+            cut = cut if cut > 0 else limit
+            parts.append(piece[:cut])
+            piece = piece[cut:]
+        current += piece
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def sheet_to_chunks(sheet_name: str, values: List[list], limit: int) -> List[str]:
+    """
+    Первая строка листа — заголовки. Каждая следующая непустая строка
+    становится чанком вида "Лист: ...\nЗаголовок: значение; ...".
+    """
+    if not values:
+        return []
+
+    header = [str(h).strip() for h in values[0]]
+    chunks = []
+    for row in values[1:]:
+        cells = [str(c).strip() for c in row]
+        if not any(cells):
+            continue
+        fields = []
+        for i, cell in enumerate(cells):
+            if not cell:
+                continue
+            title = header[i] if i < len(header) and header[i] else f"Колонка {i + 1}"
+            fields.append(f"{title}: {cell}")
+        body = "; ".join(fields)
+        for part in _split_long(body, limit):
+            chunks.append(f"Лист: {sheet_name}\n{part}")
+    return chunks
+
+
+def chunk_hash(source: str, chunk_text: str) -> str:
+    return hashlib.sha256(f"{source}\n{chunk_text}".encode("utf-8")).hexdigest()
+
+
+# =============================================================================
+# Синхронизация
+# =============================================================================
+
+async def sync_knowledge_base() -> Optional[Dict[str, int]]:
+    """
+    Сверяет листы config.KNOWLEDGE_TABS с doc_chunks по хешам чанков:
+    эмбеддинги считаются только для новых/изменённых чанков, исчезнувшие
+    удаляются, RAG-индекс обновляется инкрементально.
+    Возвращает счётчики {"added", "removed", "unchanged"} или None, если
+    синхронизация уже идёт.
+    """
+    if _sync_lock.locked():
+        logging.info("Синхронизация базы знаний уже идёт, пропускаем")
+        return None
+
+    async with _sync_lock:
+        # Желаемое состояние: hash -> (source, text). Листы, которые не
+        # удалось прочитать, не трогаем вовсе — иначе удалим их чанки.
+        desired: Dict[str, tuple] = {}
+        synced_sources = set()
+        for tab in config.KNOWLEDGE_TABS:
+            values = await asyncio.to_thread(get_sheet_values, tab)
+            if values is None:
+                logging.error(f"База знаний: лист '{tab}' не прочитан, пропускаем")
+                continue
+            source = SOURCE_PREFIX + tab
+            synced_sources.add(source)
+            for text in sheet_to_chunks(tab, values, config.KNOWLEDGE_CHUNK_CHARS):
+                desired[chunk_hash(source, text)] = (source, text)
+
+        existing = await get_doc_chunk_hashes(SOURCE_PREFIX)
+        kept_hashes = set()
+        removed_ids = []
+        for row in existing:
+            if row["source"] not in synced_sources:
+                continue
+            # Дубликаты одного и того же хеша тоже удаляем
+            if row["content_hash"] in desired and row["content_hash"] not in kept_hashes:
+                kept_hashes.add(row["content_hash"])
+            else:
+                removed_ids.append(row["id"])
+
+        new_hashes = [h for h in desired if h not in kept_hashes]
+        new_texts = [desired[h][1] for h in new_hashes]
+        embeddings = await get_embeddings(new_texts) if new_texts else []
+
+        to_insert = []
+        for h, text, emb in zip(new_hashes, new_texts, embeddings):
+            if emb is None:
+                # Не получили эмбеддинг — попробуем на следующем прогоне
+                continue
+            to_insert.append({
+                "chunk_text": text,
+                "embedding_json": json.dumps(emb),
+                "embedding": emb,
+                "source": desired[h][0],
+                "content_hash": h,
+            })
+
+        inserted_ids = await insert_hashed_doc_chunks(to_insert)
+        await delete_doc_chunks_by_ids(removed_ids)
+
+        added_rows = [
+            {"id": new_id, "chunk_text": c["chunk_text"], "embedding": c["embedding"]}
+            for new_id, c in zip(inserted_ids, to_insert)
+        ]
+        await vector_search.apply_changes(added_rows, removed_ids)
+
+        stats = {
+            "added": len(added_rows),
+            "removed": len(removed_ids),
+            "unchanged": len(kept_hashes),
+        }
+        if added_rows or removed_ids:
+            logging.info(f"База знаний синхронизирована: {stats}")
+        return stats
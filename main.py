@@ -1,5 +1,3 @@
-import os
-import json
 import logging
 import asyncio
 import aioschedule as schedule
@@ -11,6 +9,13 @@ from aiogram.client.default import DefaultBotProperties
 from config import config
 from manager_router import manager_router
 from communicator_router import communicator_router
+from knowledge_sync import sync_knowledge_base
+from metrics import log_metrics
+from openai_module import close_http_client
+from callback_answers import prewarm_callback_answers
+from notifications import manager_notifications
+from welcome_state import welcome_state
+from deletion_scheduler import deletion_scheduler
 
 
 # Настраиваем логирование в файл bot.log + в консоль
@@ -42,39 +47,35 @@ manager_dp = Dispatcher()
 
 async def remove_welcome_message():
     """
-    Периодическая задача: удаляет приветственное сообщение (если есть).
+    Периодическая задача: удаляет приветственные сообщения (если есть) во всех чатах.
     """
-    if not os.path.exists(config.CURRENT_WELCOME_FILE):
-        return
+    for chat_id in welcome_state.chats():
+        async with welcome_state.lock(chat_id):
+            data = welcome_state.get(chat_id)
+            if not data or not data.get("message_id"):
+                continue
+            message_id = data["message_id"]
 
-    try:
-        with open(config.CURRENT_WELCOME_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception as e:
-        logging.error(f"Не смогли прочитать {config.CURRENT_WELCOME_FILE}: {e}")
-        return
+            # Удаляем
+            try:
+                await manager_bot.delete_message(chat_id, message_id)
+                logging.info(f"Удалили приветственное сообщение (msg_id={message_id}) в чате {chat_id}")
+            except exceptions.TelegramBadRequest as e:
+                logging.error(f"Ошибка удаления приветствия: {e}")
 
-    if not isinstance(data, dict):
-        return
+            welcome_state.pop(chat_id)
 
-    chat_id = data.get("chat_id")
-    message_id = data.get("message_id")
-    if not chat_id or not message_id:
-        return
-
-    # Удаляем
-    try:
-        await manager_bot.delete_message(chat_id, message_id)
-        logging.info(f"Удалили приветственное сообщение (msg_id={message_id}) в чате {chat_id}")
-    except exceptions.TelegramBadRequest as e:
-        logging.error(f"Ошибка удаления приветствия: {e}")
 
-    # Обнуляем файл
+async def knowledge_sync_job():
+    """
+    Синхронизация базы знаний без падений: ошибка БД/Sheets не должна
+    останавливать поллинг ботов, а aioschedule перезапускает упавшее
+    задание каждую секунду (переносит его только после успеха).
+    """
     try:
-        with open(config.CURRENT_WELCOME_FILE, "w", encoding="utf-8") as f:
-            f.write("")
+        await sync_knowledge_base()
     except Exception as e:
-        logging.error(f"Ошибка при очистке файла {config.CURRENT_WELCOME_FILE}: {e}")
+        logging.exception(f"Ошибка синхронизации базы знаний: {e}")
 
 
 async def schedule_runner():
@@ -94,22 +95,43 @@ async def main():
 
     # Планировщик: каждые 5 минут удаляем приветственное сообщение
     schedule.every(5).minutes.do(remove_welcome_message)
+    # База знаний из Google Sheets -> doc_chunks (только изменившиеся чанки)
+    schedule.every(config.KNOWLEDGE_SYNC_MINUTES).minutes.do(knowledge_sync_job)
+    # Снимок метрик в лог
+    schedule.every(5).minutes.do(log_metrics)
+    # Заранее обновляем ответы на частые инлайн-кнопки
+    schedule.every(config.CALLBACK_PREWARM_MINUTES).minutes.do(prewarm_callback_answers)
 
     # Параллельно запускаем:
     # 1) Поллинг бота-«Менеджера» (+ chat_member)
     # 2) Поллинг бота-«Коммуникатора» (только message)
     # 3) Планировщик (schedule)
-    await asyncio.gather(
-        manager_dp.start_polling(
-            manager_bot,
-            allowed_updates=["message", "chat_member"]
-        ),
-        communicator_dp.start_polling(
-            communicator_bot,
-            allowed_updates=["message"]
-        ),
-        schedule_runner()
-    )
+    # 4) Первичная синхронизация базы знаний
+    await welcome_state.load()
+    # Отложенные удаления: проигрываем журнал и заводим таймер
+    await deletion_scheduler.start(manager_bot)
+    try:
+        await asyncio.gather(
+            manager_dp.start_polling(
+                manager_bot,
+                allowed_updates=["message", "chat_member"]
+            ),
+            communicator_dp.start_polling(
+                communicator_bot,
+                allowed_updates=["message", "callback_query"]
+            ),
+            schedule_runner(),
+            knowledge_sync_job()
+        )
+    finally:
+        # Досылаем накопленные сводки менеджеру
+        await manager_notifications.flush_all()
+        # Последний снимок приветствий на диск
+        await welcome_state.flush()
+        # Дописываем журнал удалений
+        await deletion_scheduler.close()
+        # Закрываем общий HTTP-пул OpenAI
+        await close_http_client()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,12 @@
-import json
 import time
-import os
 import logging
+import asyncio
 from typing import List
 
 from aiogram import Router, F
 from aiogram.types import Message, ChatMemberUpdated
 from aiogram.enums import ChatMemberStatus
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import ChatMemberUpdatedFilter
 
 # aiogram 3.x: фильтры chat_member_updated
@@ -19,54 +18,48 @@ from google_sheets import (
     user_exists, add_user_row, add_message_row,
     mark_message_as_spam
 )
-from openai_module import is_spam
+from moderation import moderate_message
+from notifications import manager_notifications
+from welcome_state import welcome_state
+from deletion_scheduler import deletion_scheduler
+from debounce import MessageDebouncer
+from metrics import metrics
 
 
 manager_router = Router()
 
+# Сколько символов удалённого спама показывать менеджеру в сводке
+SPAM_PREVIEW_CHARS = 300
+
+# Склейка JOIN одного чата: окно фиксированное (min = max)
+join_debouncer = MessageDebouncer(
+    min_window=config.WELCOME_EDIT_WINDOW,
+    max_window=config.WELCOME_EDIT_WINDOW,
+    max_wait=config.WELCOME_EDIT_MAX_WAIT,
+    idle_reset=config.WELCOME_IDLE_RESET
+)
+
 # -----------------------------------------
 # Вспомогательные функции
 # -----------------------------------------
 
-def get_active_welcome() -> dict | None:
-    """
-    Считываем текущее приветственное сообщение (если есть) из файла.
-    Аналог PHP: getActiveWelcome()
-    """
-    path = config.CURRENT_WELCOME_FILE
-    if not os.path.exists(path):
-        return None
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data if isinstance(data, dict) else None
-    except:
-        return None
-
-
-def save_active_welcome(data: dict):
+def render_welcome_text(usernames: List[str]) -> str:
     """
-    Сохраняем текущее приветственное сообщение.
-    Аналог PHP: saveActiveWelcome()
+    Текст приветствия: {users} в шаблоне — первые WELCOME_MAX_MENTIONS имён,
+    остальные свёрнуты в «и ещё N».
     """
-    path = config.CURRENT_WELCOME_FILE
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    shown = usernames[:config.WELCOME_MAX_MENTIONS]
+    mentions = ", ".join(shown)
+    hidden = len(usernames) - len(shown)
+    if hidden > 0:
+        mentions += f" и ещё {hidden}"
+    return config.WELCOME_TEXT.replace("{users}", mentions)
 
 
-async def create_welcome_message(bot, chat_id: int, usernames: List[str]) -> int | None:
-    """
-    Создаём новое приветственное сообщение. 
-    Аналог PHP: createWelcomeMessage()
-    Возвращаем message_id.
-    """
+def welcome_markup():
     from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-    mentions = ", ".join(usernames)
-    # Заменяем {users} в шаблоне
-    text = config.WELCOME_TEXT.replace("{users}", mentions)
-
-    markup = InlineKeyboardMarkup(inline_keyboard=[
+    return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(
                 text="Сгенерировать видео",
@@ -75,12 +68,41 @@ async def create_welcome_message(bot, chat_id: int, usernames: List[str]) -> int
         ]
     ])
 
-    try:
-        msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
-        return msg.message_id if msg else None
-    except TelegramBadRequest as e:
-        logging.error(f"Ошибка при отправке приветствия: {e}")
-        return None
+
+async def call_with_retry_after(call, what: str):
+    """
+    Вызов Telegram API с учётом лимита: на TelegramRetryAfter ждём
+    retry_after секунд и пробуем ещё раз. Ошибки логируем, возвращаем None.
+    """
+    for attempt in range(2):
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            metrics.inc("welcome.retry_after")
+            if attempt:
+                logging.error(f"Ошибка при {what}: {e}")
+                return None
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            logging.error(f"Ошибка при {what}: {e}")
+            return None
+
+
+async def create_welcome_message(bot, chat_id: int, usernames: List[str]) -> int | None:
+    """
+    Создаём новое приветственное сообщение. 
+    Аналог PHP: createWelcomeMessage()
+    Возвращаем message_id.
+    """
+    msg = await call_with_retry_after(
+        lambda: bot.send_message(
+            chat_id=chat_id,
+            text=render_welcome_text(usernames),
+            reply_markup=welcome_markup()
+        ),
+        "отправке приветствия"
+    )
+    return msg.message_id if msg else None
 
 
 async def update_welcome_message(bot, chat_id: int, message_id: int,
@@ -88,32 +110,24 @@ async def update_welcome_message(bot, chat_id: int, message_id: int,
     """
     Обновляем текущее приветственное сообщение, добавляя новых участников.
     Аналог PHP: updateWelcomeMessage()
+    Если видимый текст не изменился (имена ушли в «и ещё N» не меняя
+    его), сообщение не редактируем.
     """
-    from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-
-    merged = list(set(old_users + new_users))
-    mentions = ", ".join(merged)
-    text = config.WELCOME_TEXT.replace("{users}", mentions)
-
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text="Сгенерировать видео",
-                url="https://t.me/sp_ai_montage_bot"
-            )
-        ]
-    ])
-
-    try:
-        await bot.edit_message_text(
+    merged = list(dict.fromkeys(old_users + new_users))
+    text = render_welcome_text(merged)
+    if text == render_welcome_text(old_users):
+        return merged
+
+    metrics.inc("welcome.edits")
+    await call_with_retry_after(
+        lambda: bot.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
             text=text,
-            reply_markup=markup
-        )
-    except TelegramBadRequest as e:
-        logging.error(f"Ошибка при редактировании приветствия: {e}")
-
+            reply_markup=welcome_markup()
+        ),
+        "редактировании приветствия"
+    )
     return merged
 
 
@@ -127,53 +141,26 @@ async def delete_welcome_message(bot, chat_id: int, message_id: int):
     except TelegramBadRequest as e:
         logging.error(f"Ошибка при удалении приветствия: {e}")
 
-    # Чистим файл
-    path = config.CURRENT_WELCOME_FILE
-    if os.path.exists(path):
-        with open(path, "w", encoding="utf-8") as f:
-            f.write("")
+    # Забываем приветствие этого чата
+    welcome_state.pop(chat_id)
 
 
-async def notify_manager(bot, text: str):
+async def notify_manager(bot, text: str, kind: str = "event"):
     """
     Отправляем уведомление менеджеру (админу).
     Аналог PHP: notifyManager()
+    События одного типа (kind: join, leave, spam, ...) за окно
+    NOTIFY_DIGEST_WINDOW уходят одной сводкой; срочные — сразу.
     """
-    if config.MANAGER_CHAT_ID:
-        try:
-            await bot.send_message(chat_id=config.MANAGER_CHAT_ID, text=text)
-        except TelegramBadRequest as e:
-            logging.error(f"Ошибка при уведомлении менеджера: {e}")
+    await manager_notifications.notify(bot, kind, text)
 
 
 def schedule_message_for_deletion(chat_id: int, message_id: int, delay: int = 60):
     """
-    Если хотите сохранять сообщение для дальнейшего удаления через N секунд/минут 
-    (аналог PHP: toDelete.json). Вызывается где нужно.
+    Удалить сообщение через delay секунд (аналог PHP: toDelete.json).
+    Вызывается где нужно; очередь переживает перезапуск (deletion_scheduler).
     """
-    path = config.TO_DELETE_FILE
-    now = time.time()
-    entry = {
-        "chat_id": chat_id,
-        "message_id": message_id,
-        "delete_after": now + delay
-    }
-
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            if not isinstance(data, list):
-                data = []
-        except:
-            data = []
-    else:
-        data = []
-
-    data.append(entry)
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    deletion_scheduler.schedule(chat_id, message_id, delay)
 
 
 # -----------------------------------------
@@ -195,7 +182,7 @@ async def handle_new_members(bot, chat_id: int, new_members: List, reason: str =
             f"ПРИСОЕДИНИЛСЯ к чату {chat_id}.\n"
             f"Событие: {reason}"
         )
-        await notify_manager(bot, msg)
+        await notify_manager(bot, msg, "join")
 
     # Список имён
     new_usernames = []
@@ -207,64 +194,42 @@ async def handle_new_members(bot, chat_id: int, new_members: List, reason: str =
             ln = m.last_name or ""
             new_usernames.append(f"{fn} {ln}".strip())
 
-    # Логика приветствия
-    active = get_active_welcome()
-    now = time.time()
-
-    if active:
-        created_at = active.get("created_at", 0)
-        old_msg_id = active.get("message_id")
-        mentioned = active.get("mentioned", [])
-        old_chat_id = active.get("chat_id")
-
-        if (now - created_at) > config.WELCOME_LIFETIME or (old_chat_id != chat_id):
-            # Удаляем старое (если есть), создаём новое
-            if old_msg_id and old_chat_id:
-                await delete_welcome_message(bot, old_chat_id, old_msg_id)
-            new_id = await create_welcome_message(bot, chat_id, new_usernames)
-            if new_id:
-                data = {
-                    "chat_id": chat_id,
-                    "message_id": new_id,
-                    "created_at": now,
-                    "mentioned": new_usernames
-                }
-                save_active_welcome(data)
-        else:
+    # Волна входов склеивается (join_debouncer): первый вошедший получает
+    # приветствие сразу, дальше — одна правка на окно WELCOME_EDIT_WINDOW
+    batch = await join_debouncer.collect(chat_id, new_usernames)
+    if batch is None:
+        return  # имена уже в пачке, которую обработает другой вызов
+    new_usernames = list(dict.fromkeys(name for names in batch for name in names))
+
+    # Своё приветствие в каждом чате; пачки одного чата — по очереди,
+    # чтобы не создать два приветствия и не потерять имена
+    async with welcome_state.lock(chat_id):
+        active = welcome_state.get(chat_id)
+        now = time.time()
+
+        if active and (now - active.get("created_at", 0)) <= config.WELCOME_LIFETIME:
             # Обновляем старое
-            if old_msg_id:
-                merged = await update_welcome_message(
-                    bot, chat_id, old_msg_id, mentioned, new_usernames
-                )
-                data = {
-                    "chat_id": chat_id,
-                    "message_id": old_msg_id,
-                    "created_at": created_at,
-                    "mentioned": merged
-                }
-                save_active_welcome(data)
-            else:
-                # Нет message_id — просто создаём
-                new_id = await create_welcome_message(bot, chat_id, new_usernames)
-                if new_id:
-                    data = {
-                        "chat_id": chat_id,
-                        "message_id": new_id,
-                        "created_at": now,
-                        "mentioned": new_usernames
-                    }
-                    save_active_welcome(data)
-    else:
-        # Нет активного приветствия
+            old_msg_id = active["message_id"]
+            merged = await update_welcome_message(
+                bot, chat_id, old_msg_id, active.get("mentioned", []), new_usernames
+            )
+            welcome_state.set(chat_id, {
+                "message_id": old_msg_id,
+                "created_at": active.get("created_at", now),
+                "mentioned": merged
+            })
+            return
+
+        if active:
+            # Устарело — удаляем и создаём новое
+            await delete_welcome_message(bot, chat_id, active["message_id"])
         new_id = await create_welcome_message(bot, chat_id, new_usernames)
         if new_id:
-            data = {
-                "chat_id": chat_id,
+            welcome_state.set(chat_id, {
                 "message_id": new_id,
                 "created_at": now,
                 "mentioned": new_usernames
-            }
-            save_active_welcome(data)
+            })
 
 
 # -----------------------------------------
@@ -285,7 +250,7 @@ async def handle_member_left(bot, chat_id: int, user, reason: str = ""):
         f"покинул чат {chat_id}.\n"
         f"Событие: {reason}"
     )
-    await notify_manager(bot, msg)
+    await notify_manager(bot, msg, "leave")
 
 
 # -----------------------------------------
@@ -363,7 +328,7 @@ async def handle_group_text_message(message: Message):
     Обработка текстовых сообщений в группе:
     - Проверка пользователя в Sheets
     - Сохранение в Sheets
-    - Проверка на спам (OpenAI)
+    - Модерация (OpenAI): спам и оскорбления одним запросом
     """
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -391,33 +356,41 @@ async def handle_group_text_message(message: Message):
         spam_flag="No"
     )
 
-    # 3) Проверка на спам (если нужно). Предполагаем is_spam — асинхронная
-    #    Если нет — уберите await
-    if (await is_spam(message.text)):
-        # 3.1) Пересылаем админу (MANAGER_CHAT_ID)
-        try:
-            await message.bot.forward_message(
-                chat_id=config.MANAGER_CHAT_ID,
-                from_chat_id=chat_id,
-                message_id=message.message_id
-            )
-        except TelegramBadRequest as e:
-            logging.error(f"Ошибка пересылки админу: {e}")
+    # 3) Модерация: один запрос к GPT на все метки; сообщения из
+    #    параллельных хендлеров проверяются пачкой
+    verdict = await moderate_message(message.text, user_id)
+    display_name = f"@{username}" if username else full_name
 
-        # 3.2) Удаляем из чата
+    if verdict["spam"]:
+        # 3.1) Удаляем из чата
         try:
             await message.bot.delete_message(chat_id, message.message_id)
         except TelegramBadRequest as e:
             logging.error(f"Ошибка удаления спам-сообщения: {e}")
 
-        # 3.3) Помечаем как спам в Sheets
+        # 3.2) Помечаем как спам в Sheets
         mark_message_as_spam(message.message_id)
 
-        # 3.4) Уведомляем менеджера
-        display_name = f"@{username}" if username else full_name
-        note = f"Удалено СПАМ-сообщение от {display_name} (ID: {user_id})."
-        await notify_manager(message.bot, note)
+        # 3.3) Уведомляем менеджера: текст спама идёт в сводку вместо
+        #      пересылки каждого сообщения (во время рейда — одна сводка)
+        text = message.text
+        if len(text) > SPAM_PREVIEW_CHARS:
+            text = text[:SPAM_PREVIEW_CHARS] + "…"
+        note = (
+            f"Удалено СПАМ-сообщение от {display_name} (ID: {user_id}) "
+            f"в чате {chat_id}:\n{text}"
+        )
+        await notify_manager(message.bot, note, "spam")
+
+    elif verdict["insult"]:
+        # Оскорбление не удаляем, а показываем менеджеру
+        confidence = verdict["confidence"]["insult"]
+        note = (
+            f"Возможное оскорбление от {display_name} (ID: {user_id}) "
+            f"в чате {chat_id}, уверенность {confidence:.2f}:\n{message.text}"
+        )
+        await notify_manager(message.bot, note, "insult")
 
     # Пример: если хотите удалить сообщение через schedule:
     # schedule_message_for_deletion(chat_id, message.message_id, delay=120)
-    # (Удалится через 2 минуты, когда сработает schedule.run_pending())
+    # (Удалится через 2 минуты — таймер deletion_scheduler)
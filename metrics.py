@@ -0,0 +1,83 @@
+import json
+import time
+import logging
+from collections import deque
+from typing import Dict, Any, List
+
+
+# =============================================================================
+# Простые in-process метрики: счётчики, gauge и выборки задержек
+# =============================================================================
+
+class Metrics:
+    """
+    Счётчики (inc), текущие значения (gauge) и последние max_samples замеров
+    (observe) для перцентилей. Периодически сбрасываются в лог (log_metrics).
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.samples: Dict[str, deque] = {}
+        self._share_prefixes: List[str] = []
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.max_samples)
+        samples.append(value)
+
+    def track_shares(self, prefix: str) -> None:
+        """Добавлять в snapshot доли счётчиков с этим префиксом (например, по тирам)."""
+        if prefix not in self._share_prefixes:
+            self._share_prefixes.append(prefix)
+
+    def shares(self, prefix: str) -> Dict[str, float]:
+        group = {
+            name[len(prefix):]: value
+            for name, value in self.counters.items()
+            if name.startswith(prefix)
+        }
+        total = sum(group.values())
+        return {k: round(v / total, 4) for k, v in group.items()} if total else {}
+
+    @staticmethod
+    def _percentile(sorted_values: List[float], p: float) -> float:
+        idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+        return sorted_values[idx]
+
+    def snapshot(self) -> Dict[str, Any]:
+        timings = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            values = sorted(samples)
+            timings[name] = {
+                "count": len(values),
+                "p50": round(self._percentile(values, 50), 4),
+                "p95": round(self._percentile(values, 95), 4),
+                "p99": round(self._percentile(values, 99), 4),
+            }
+        return {
+            "uptime_s": int(time.time() - self.started_at),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": timings,
+            "shares": {p: self.shares(p) for p in self._share_prefixes},
+        }
+
+
+metrics = Metrics()
+
+
+async def log_metrics():
+    """Периодическая задача: пишет снимок метрик в лог одной JSON-строкой."""
+    logging.info("METRICS " + json.dumps(metrics.snapshot(), ensure_ascii=False))
@@ -0,0 +1,374 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from urllib.parse import urlsplit
+from typing import List, Dict, Any, Optional
+
+import aiofiles
+from cachetools import TTLCache
+
+from config import config
+from metrics import metrics
+from openai_module import moderate_batch, MODERATION_LABELS
+from single_flight import SingleFlight
+
+
+# Счётчики "moderation.settled.<тир>": кто вынес вердикт сообщению
+metrics.track_shares("moderation.settled.")
+
+
+# =============================================================================
+# Локальный тир: правила, списки доменов, SimHash подтверждённого спама
+# =============================================================================
+
+_URL_RE = re.compile(
+    r"(?:https?://|www\.)[^\s]+|\b(?:[a-z0-9-]+\.)+(?:com|ru|net|org|io|me|ly|be|gl|info|biz|xyz|top|site|online|shop)\b(?:/[^\s]*)?",
+    re.IGNORECASE
+)
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+# Шаблоны однозначного спама (регулярки, без учёта регистра): совпадение —
+# окончательный вердикт без LLM. Только сочетания, которых не бывает в
+# обычной переписке: обещание дохода вместе с суммой в день/неделю или с
+# призывом написать
+SPAM_PATTERNS = [
+    r"пассивн\w+\s+доход\w*.*(?:пиши|пишите|напиши|@\w{4,}|t\.me/)",
+    r"(?:доход|заработ\w*|прибыл\w*)\s+(?:от\s+)?\d[\d\s]*\s*(?:₽|р\b|руб\w*|\$|usdt|долл\w*)\s*(?:в|за)\s+(?:день|сутки|недел\w*)",
+]
+
+# Признаки возможного спама, которые встречаются и в обычной переписке
+# («заработал 5 тысяч», «напишите в личку, скину адрес», «принимаете
+# USDT?», «рядом открыли казино»): такие сообщения не считаем ни спамом,
+# ни заведомо чистыми и отдаём LLM
+SPAM_HINT_PATTERNS = [
+    r"пассивн\w+\s+доход",
+    r"\b(?:казино|ставки на спорт|букмекер)\w*",
+    r"\b(?:крипт\w*|usdt|бинанс|binance)\b.*\b(?:доход|заработ|прибыл)\w*",
+    r"заработ\w*\s+(?:от|до)?\s*\d+",
+    r"(?:пиши|пишите|напиши)\w*\s+(?:в\s+)?(?:лс|личк|личны)",
+    r"\bудал[её]нн\w+\s+работ\w*",
+]
+
+# Признаки возможного оскорбления: такие короткие сообщения не считаем
+# заведомо чистыми и отдаём LLM
+_INSULT_HINT_RE = re.compile(
+    r"идиот|дебил|туп(?:ой|ая|ые|иц)|урод|дур(?:а|ак)|кретин|мудак|сук[аи]|"
+    r"ху[йеёя]|пизд|бля|[её]б[аaнл]",
+    re.IGNORECASE
+)
+
+_spam_res = [re.compile(p, re.IGNORECASE) for p in SPAM_PATTERNS + list(config.MODERATION_SPAM_PATTERNS)]
+_spam_hint_res = [re.compile(p, re.IGNORECASE) for p in SPAM_HINT_PATTERNS]
+
+
+def _domain(url: str) -> str:
+    if not re.match(r"https?://", url, re.IGNORECASE):
+        url = "http://" + url
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def _domain_in(host: str, domains: List[str]) -> bool:
+    """host совпадает с доменом из списка или является его поддоменом."""
+    return any(host == d or host.endswith("." + d) for d in domains)
+
+
+def _simhash(text: str, bits: int = 64) -> Optional[int]:
+    """
+    SimHash по словным биграммам. Для слишком коротких текстов — None:
+    на них отпечаток ненадёжен.
+    """
+    words = [w.lower() for w in _WORD_RE.findall(text)]
+    if len(words) < 5:
+        return None
+    weights = [0] * bits
+    for shingle in zip(words, words[1:]):
+        h = int.from_bytes(hashlib.blake2b(" ".join(shingle).encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(bits):
+            weights[i] += 1 if (h >> i) & 1 else -1
+    return sum(1 << i for i in range(bits) if weights[i] > 0)
+
+
+class SpamSimHashStore:
+    """
+    Отпечатки подтверждённого спама. Поиск похожих — по 4 полосам по 16 бит:
+    при расстоянии Хэмминга <= 3 хотя бы одна полоса совпадает точно.
+    """
+
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, max_distance: int = 3, max_size: int = 10000):
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.hashes: List[int] = []
+        self.bands: List[Dict[int, List[int]]] = [{} for _ in range(self.BANDS)]
+
+    def _band_keys(self, h: int) -> List[int]:
+        mask = (1 << self.BAND_BITS) - 1
+        return [(h >> (b * self.BAND_BITS)) & mask for b in range(self.BANDS)]
+
+    def add_hash(self, h: int) -> None:
+        if len(self.hashes) >= self.max_size or self.contains_hash(h):
+            return
+        self.hashes.append(h)
+        for band, key in zip(self.bands, self._band_keys(h)):
+            band.setdefault(key, []).append(h)
+
+    def contains_hash(self, h: int) -> bool:
+        for band, key in zip(self.bands, self._band_keys(h)):
+            for candidate in band.get(key, ()):
+                if bin(candidate ^ h).count("1") <= self.max_distance:
+                    return True
+        return False
+
+    def add(self, text: str) -> None:
+        h = _simhash(text)
+        if h is not None:
+            self.add_hash(h)
+
+    def contains(self, text: str) -> bool:
+        h = _simhash(text)
+        return h is not None and self.contains_hash(h)
+
+
+spam_store = SpamSimHashStore()
+
+
+def _verdict(tier: str, **labels: float) -> Dict[str, Any]:
+    verdict: Dict[str, Any] = {name: labels.get(name, 0.0) >= 0.5 for name in MODERATION_LABELS}
+    verdict["confidence"] = {name: labels.get(name, 0.0) for name in MODERATION_LABELS}
+    verdict["tier"] = tier
+    return verdict
+
+
+def local_verdict(text: str, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Быстрые локальные проверки до LLM. Возвращает вердикт, если случай
+    однозначный, иначе None (сообщение уходит в GPT).
+    """
+    if user_id is not None and user_id in config.MODERATION_TRUSTED_USERS:
+        return _verdict("trusted")
+
+    urls = _URL_RE.findall(text)
+    hosts = [_domain(u) for u in urls]
+    if any(_domain_in(h, config.MODERATION_DENIED_DOMAINS) for h in hosts):
+        return _verdict("deny_domain", spam=1.0)
+
+    if any(r.search(text) for r in _spam_res):
+        return _verdict("spam_pattern", spam=1.0)
+
+    if spam_store.contains(text):
+        return _verdict("spam_simhash", spam=1.0)
+
+    if _INSULT_HINT_RE.search(text) or any(r.search(text) for r in _spam_hint_res):
+        return None
+
+    # Короткие реплики ("+1", "спасибо!", эмодзи), в т.ч. со ссылкой из белого списка
+    rest = _URL_RE.sub(" ", text)
+    words = _WORD_RE.findall(rest)
+    all_links_allowed = all(_domain_in(h, config.MODERATION_ALLOWED_DOMAINS) for h in hosts)
+    if all_links_allowed and len(words) <= config.MODERATION_SHORT_WORDS:
+        return _verdict("short" if not hosts else "allow_domain")
+
+    return None
+
+
+# =============================================================================
+# Микро-батчинг модерации
+# =============================================================================
+
+class ModerationBatcher:
+    """
+    Собирает сообщения, пришедшие в течение window секунд (или пока их не
+    наберётся max_batch), и проверяет их одним запросом moderate_batch.
+    Каждый вызывающий получает свой вердикт через future.
+    """
+
+    def __init__(self, window: float, max_batch: int, max_chars: int = 12000):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_chars = max_chars
+        self._pending: List[tuple] = []  # (текст, future)
+        self._pending_chars = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, text: str) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # Лимит по символам: огромный батч — это огромный промпт
+        if self._pending and self._pending_chars + len(text) > self.max_chars:
+            self._flush()
+
+        self._pending.append((text, future))
+        self._pending_chars += len(text)
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _run(self, batch: List[tuple]) -> None:
+        texts = [text for text, _ in batch]
+        try:
+            verdicts = await moderate_batch(texts)
+        except Exception as e:
+            logging.error(f"Ошибка пакетной модерации: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logging.debug(f"Модерация: {len(batch)} сообщений одним запросом")
+        for (_, future), verdict in zip(batch, verdicts):
+            if not future.done():
+                future.set_result(verdict)
+
+
+moderation_batcher = ModerationBatcher(
+    window=config.MODERATION_BATCH_WINDOW_MS / 1000,
+    max_batch=config.MODERATION_BATCH_MAX
+)
+
+
+# =============================================================================
+# Кеш вердиктов по нормализованному отпечатку текста
+# =============================================================================
+
+_URL_QUERY_RE = re.compile(r"(https?://[^\s?#]+)[?#][^\s]*", re.IGNORECASE)
+_DIGITS_RE = re.compile(r"\d+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def text_fingerprint(text: str) -> str:
+    """
+    Отпечаток для кеша: регистр, пробелы, цифры и query/fragment ссылок
+    не важны — "Скидка 50%! site.com/?ref=1" и "скидка 70%!  site.com/?ref=2"
+    дают один отпечаток.
+    """
+    normalized = _URL_QUERY_RE.sub(r"\1", text.lower())
+    normalized = _DIGITS_RE.sub("0", normalized)
+    normalized = _SPACES_RE.sub(" ", normalized).strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class VerdictCache:
+    """
+    TTL-кеш вердиктов LLM + постоянное множество отпечатков подтверждённого
+    спама. Спам дописывается в файл (по строке "<sha1> <simhash|->"), при
+    старте файл читается обратно — вместе с SimHash-отпечатками.
+    """
+
+    def __init__(self, path: str, maxsize: int, ttl: int):
+        self.path = path
+        self.verdicts: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.spam: set = set()
+        self._file_lock = asyncio.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if not parts:
+                        continue
+                    self.spam.add(parts[0])
+                    if len(parts) > 1 and parts[1] != "-":
+                        spam_store.add_hash(int(parts[1], 16))
+        except (OSError, ValueError) as e:
+            logging.error(f"Не смогли прочитать {self.path}: {e}")
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        if fingerprint in self.spam:
+            return _verdict("cache", spam=1.0)
+        verdict = self.verdicts.get(fingerprint)
+        if verdict is None:
+            return None
+        return {**verdict, "confidence": dict(verdict["confidence"]), "tier": "cache"}
+
+    def put(self, fingerprint: str, verdict: Dict[str, Any]) -> None:
+        self.verdicts[fingerprint] = verdict
+
+    async def confirm_spam(self, fingerprint: str, text: str) -> None:
+        """Запоминает спам навсегда: в памяти, в SimHash-хранилище и в файле."""
+        if fingerprint in self.spam:
+            return
+        self.spam.add(fingerprint)
+        h = _simhash(text)
+        if h is not None:
+            spam_store.add_hash(h)
+        line = f"{fingerprint} {format(h, 'x') if h is not None else '-'}\n"
+        try:
+            async with self._file_lock:
+                async with aiofiles.open(self.path, "a", encoding="utf-8") as f:
+                    await f.write(line)
+        except OSError as e:
+            logging.error(f"Не смогли записать {self.path}: {e}")
+
+
+verdict_cache = VerdictCache(
+    path=config.SPAM_FINGERPRINTS_FILE,
+    maxsize=config.MODERATION_CACHE_SIZE,
+    ttl=config.MODERATION_CACHE_TTL
+)
+
+# Вердикты, которые прямо сейчас ждут LLM: волна одинаковых сообщений
+# ждёт один и тот же запрос
+_in_flight = SingleFlight()
+
+
+async def _llm_verdict(fingerprint: str, text: str) -> Dict[str, Any]:
+    async def ask_llm():
+        verdict = await moderation_batcher.submit(text)
+        verdict["tier"] = "llm"
+        # Сбой API / очереди / разбора — не вердикт: иначе волна спама во
+        # время сбоя закешируется как чистая на весь TTL
+        if verdict.get("error"):
+            metrics.inc("moderation.llm_failed")
+        else:
+            verdict_cache.put(fingerprint, verdict)
+        return verdict
+
+    verdict, shared = await _in_flight.run(fingerprint, ask_llm)
+    if shared:
+        return {**verdict, "confidence": dict(verdict["confidence"]), "tier": "cache"}
+
+    # Уверенный спам от LLM запоминаем: копии отсечём без API
+    if verdict["confidence"].get("spam", 0.0) >= config.MODERATION_CONFIRM_CONFIDENCE:
+        await verdict_cache.confirm_spam(fingerprint, text)
+    return verdict
+
+
+async def moderate_message(text: str, user_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Вердикт модерации для сообщения группы (см. openai_module.moderate)
+    плюс ключ "tier" — кто его вынес. Порядок: локальные правила, кеш
+    вердиктов по отпечатку текста, и только потом GPT, причём запросы из
+    параллельных хендлеров склеиваются в один вызов API.
+    """
+    verdict = local_verdict(text, user_id)
+    if verdict is None:
+        fingerprint = text_fingerprint(text)
+        verdict = verdict_cache.get(fingerprint)
+        if verdict is None:
+            verdict = await _llm_verdict(fingerprint, text)
+
+    metrics.inc(f"moderation.settled.{verdict['tier']}")
+    return verdict
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import config
+from metrics import metrics
+
+
+# Заголовки сводок по типам событий
+DIGEST_TITLES = {
+    "join": "Присоединились к чату",
+    "leave": "Покинули чат",
+    "mention": "Упоминания менеджера",
+    "spam": "Удалён спам",
+    "insult": "Возможные оскорбления",
+}
+
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+# =============================================================================
+# Уведомления менеджера: сводки по типам и срочная полоса
+# =============================================================================
+
+class _Pending:
+    __slots__ = ("bot", "texts", "timer")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.texts: List[str] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class NotificationAggregator:
+    """
+    Обычные события копятся по типам (join, leave, spam, ...) и через
+    window секунд после первого из них уходят одним сообщением-сводкой;
+    одиночное событие уходит как есть. Срочные типы (urgent_kinds) идут
+    сразу и обгоняют сводки: отправка в чат менеджера — по одному
+    сообщению, и срочные стоят в очереди впереди.
+    """
+
+    def __init__(self, window: float, urgent_kinds: List[str]):
+        self.window = window
+        self.urgent_kinds = set(urgent_kinds)
+        self._pending: Dict[str, _Pending] = {}
+        self._send_lock = asyncio.Lock()
+        self._urgent_waiting = 0
+        self._urgent_done: Optional[asyncio.Event] = None
+        self._flushes: set = set()
+
+    async def notify(self, bot, kind: str, text: str, urgent: Optional[bool] = None) -> None:
+        """Уведомить менеджера о событии типа kind."""
+        if not config.MANAGER_CHAT_ID:
+            return
+        if urgent is None:
+            urgent = kind in self.urgent_kinds
+        if urgent or self.window <= 0:
+            metrics.inc(f"notify.urgent.{kind}" if urgent else f"notify.sent.{kind}")
+            await self._send(bot, text, urgent=urgent)
+            return
+
+        pending = self._pending.get(kind)
+        if pending is None:
+            pending = self._pending[kind] = _Pending(bot)
+            pending.timer = asyncio.get_running_loop().call_later(self.window, self._start_flush, kind)
+        pending.texts.append(text)
+        metrics.inc(f"notify.queued.{kind}")
+
+    def _start_flush(self, kind: str) -> None:
+        task = asyncio.create_task(self.flush(kind))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self, kind: str) -> None:
+        """Отправить накопленную сводку типа kind."""
+        pending = self._pending.pop(kind, None)
+        if pending is None or not pending.texts:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+        metrics.inc(f"notify.digest.{kind}")
+        metrics.observe("notify.digest_size", len(pending.texts))
+        await self._send(pending.bot, self.render(kind, pending.texts))
+
+    async def flush_all(self) -> None:
+        """Отправить все сводки сразу (при остановке бота)."""
+        for kind in list(self._pending):
+            await self.flush(kind)
+
+    @staticmethod
+    def render(kind: str, texts: List[str]) -> str:
+        if len(texts) == 1:
+            return texts[0]
+        title = DIGEST_TITLES.get(kind, kind)
+        msg = f"Сводка: {title} — {len(texts)}"
+        for i, text in enumerate(texts):
+            item = f"\n\n• {text}"
+            rest = len(texts) - i
+            tail = f"\n\n… и ещё {rest}"
+            if len(msg) + len(item) + len(tail) > TELEGRAM_TEXT_LIMIT:
+                return msg + tail
+            msg += item
+        return msg
+
+    async def _send(self, bot, text: str, urgent: bool = False) -> None:
+        if urgent:
+            self._urgent_waiting += 1
+            try:
+                async with self._send_lock:
+                    await self._deliver(bot, text)
+            finally:
+                self._urgent_waiting -= 1
+                if not self._urgent_waiting and self._urgent_done is not None:
+                    self._urgent_done.set()
+                    self._urgent_done = None
+            return
+
+        # Сводки пропускают вперёд срочные уведомления: если срочное ждёт,
+        # уступаем ему очередь даже после захвата блокировки
+        while True:
+            while self._urgent_waiting:
+                self._urgent_done = self._urgent_done or asyncio.Event()
+                await self._urgent_done.wait()
+            await self._send_lock.acquire()
+            if not self._urgent_waiting:
+                break
+            self._send_lock.release()
+        try:
+            await self._deliver(bot, text)
+        finally:
+            self._send_lock.release()
+
+    @staticmethod
+    async def _deliver(bot, text: str) -> None:
+        for attempt in range(2):
+            try:
+                await bot.send_message(chat_id=config.MANAGER_CHAT_ID, text=text)
+                return
+            except TelegramRetryAfter as e:
+                metrics.inc("notify.retry_after")
+                if attempt:
+                    logging.error(f"Ошибка при уведомлении менеджера: {e}")
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                logging.error(f"Ошибка при уведомлении менеджера: {e}")
+                return
+
+
+manager_notifications = NotificationAggregator(
+    window=config.NOTIFY_DIGEST_WINDOW,
+    urgent_kinds=config.NOTIFY_URGENT_KINDS
+)
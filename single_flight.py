@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+# =============================================================================
+# Один запрос на ключ: одновременные вызовы ждут результат первого
+# =============================================================================
+
+class SingleFlight:
+    """
+    run(key, factory) выполняет factory() один раз на key, пока тот в
+    работе: остальные вызовы с тем же key ждут его результат (или его
+    исключение). Если первый вызов отменили, ждущие не зависают —
+    следующий из них сам выполняет factory().
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Возвращает (результат, shared): shared=True — результат чужого вызова."""
+        while True:
+            pending = self._in_flight.get(key)
+            if pending is None:
+                break
+            try:
+                return await asyncio.shield(pending), True
+            except asyncio.CancelledError:
+                # Отменили первый вызов, а не нас — пробуем сами
+                if pending.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await factory()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Помечаем исключение полученным: ожидающих могло и не быть
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._in_flight.pop(key, None)
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.Settings требует эти переменные; в тестах сеть и БД не нужны
+for key, value in {
+    "DB_HOST": "localhost", "DB_PORT": "3306", "DB_USER": "test", "DB_PASS": "test",
+    "DB_NAME": "test", "BOT_TOKEN_1": "1:test", "BOT_TOKEN_2": "2:test",
+    "BOT_TOKEN_3": "3:test", "GOOGLE_SHEET_ID": "test", "OPENAI_GPT_KEY": "test",
+    "OPENAI_EMBEDDING_KEY": "test", "OPENAI_WHISPER_KEY": "test",
+    "SERVICE_ACCOUNT_JSON": "{}",
+}.items():
+    os.environ.setdefault(key, value)
+
+
+SCHEMA = [
+    """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER NOT NULL,
+        username TEXT
+    )
+    """,
+    """
+    CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        message_type TEXT,
+        file_path TEXT
+    )
+    """,
+]
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """db.engine на временной SQLite-базе с таблицами users и chat_history."""
+    import asyncio
+    import db
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+
+    async def create():
+        async with engine.begin() as conn:
+            for statement in SCHEMA:
+                await conn.execute(text(statement))
+
+    asyncio.run(create())
+    monkeypatch.setattr(db, "engine", engine)
+    yield engine
+    asyncio.run(engine.dispose())
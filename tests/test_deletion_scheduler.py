@@ -0,0 +1,47 @@
+import json
+import asyncio
+
+import deletion_scheduler as ds
+from config import config
+
+
+def _journal_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_schedule_during_startup_survives_compaction(tmp_path, monkeypatch):
+    journal = tmp_path / "delete_journal.jsonl"
+    # В основном отработанные записи — start() сожмёт журнал
+    with open(journal, "w", encoding="utf-8") as f:
+        for i in range(200):
+            f.write(json.dumps({"op": "add", "chat_id": 1, "message_id": i, "delete_after": 0}) + "\n")
+            f.write(json.dumps({"op": "done", "chat_id": 1, "message_id": i}) + "\n")
+        f.write(json.dumps({"op": "add", "chat_id": 1, "message_id": 500, "delete_after": 4e9}) + "\n")
+    monkeypatch.setattr(config, "TO_DELETE_FILE", str(tmp_path / "toDelete.json"))
+
+    scheduler = ds.DeletionScheduler(str(journal), batch_slack=0)
+    compact = scheduler._compact
+
+    async def compact_with_concurrent_schedule(pending):
+        # Обработчик успел запланировать удаление, пока журнал сжимается
+        scheduler.schedule(2, 7, 3600)
+        await asyncio.sleep(0)
+        await compact(pending)
+
+    monkeypatch.setattr(scheduler, "_compact", compact_with_concurrent_schedule)
+
+    async def scenario():
+        await scheduler.start(bot=object())
+        await scheduler.close()
+
+    asyncio.run(scenario())
+
+    lines = _journal_lines(journal)
+    keys = {(r["chat_id"], r["message_id"]) for r in lines if r["op"] == "add"}
+    assert keys == {(1, 500), (2, 7)}
+    assert len(lines) == 2
+
+    restored = ds.DeletionScheduler(str(journal), batch_slack=0)
+    pending = asyncio.run(restored._replay())
+    assert {(c, m) for _, c, m in pending} == {(1, 500), (2, 7)}
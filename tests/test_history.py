@@ -0,0 +1,151 @@
+import asyncio
+
+from sqlalchemy import text
+
+import communicator_router
+import data_manager
+import db
+
+CHAT_ID = 555
+
+
+async def _add_user(engine) -> int:
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            text("INSERT INTO users (telegram_id, username) VALUES (:tg, 'tester')"),
+            {"tg": CHAT_ID}
+        )
+        return result.lastrowid
+
+
+async def _rows(engine, user_id):
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text("SELECT role, content FROM chat_history WHERE user_id = :uid ORDER BY id"),
+            {"uid": user_id}
+        )
+        return [tuple(r) for r in result.fetchall()]
+
+
+async def _persist_turns(user_id, count):
+    for i in range(count):
+        await communicator_router.persist_turn(CHAT_ID, user_id, f"вопрос {i}", "text", None, f"ответ {i}")
+        await asyncio.gather(*list(communicator_router._background_tasks))
+
+
+def _fresh_cache(monkeypatch):
+    monkeypatch.setattr(data_manager, "conversation_cache", data_manager.ConversationCache(100, 30))
+
+
+def test_messages_count_reads_scalar(sqlite_db):
+    async def scenario():
+        user_id = await _add_user(sqlite_db)
+        await db.save_chat_message(user_id, "user", "привет")
+        await db.save_chat_message(user_id, "assistant", "здравствуйте")
+        return await db.get_all_messages_count(user_id)
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_persist_turn_saves_and_summarizes_oldest(sqlite_db, monkeypatch):
+    _fresh_cache(monkeypatch)
+    summarized = []
+
+    async def fake_summary(messages):
+        summarized.append([m["content"] for m in messages])
+        return "Краткое содержание ранней переписки: сводка"
+
+    monkeypatch.setattr(data_manager, "summarize_history", fake_summary)
+
+    async def scenario():
+        user_id = await _add_user(sqlite_db)
+        await _persist_turns(user_id, 11)
+        return await _rows(sqlite_db, user_id)
+
+    rows = asyncio.run(scenario())
+
+    # 22 сообщения -> 10 старейших заменены одной сводкой в начале истории
+    assert len(summarized) == 1
+    assert summarized[0][0] == "вопрос 0"
+    assert rows[0] == ("assistant", "Краткое содержание ранней переписки: сводка")
+    assert len(rows) == 13
+    assert rows[-2:] == [("user", "вопрос 10"), ("assistant", "ответ 10")]
+
+
+def test_persist_turn_keeps_history_when_summary_fails(sqlite_db, monkeypatch):
+    _fresh_cache(monkeypatch)
+
+    async def no_summary(messages):
+        return None
+
+    monkeypatch.setattr(data_manager, "summarize_history", no_summary)
+
+    async def scenario():
+        user_id = await _add_user(sqlite_db)
+        await _persist_turns(user_id, 11)
+        return await _rows(sqlite_db, user_id)
+
+    rows = asyncio.run(scenario())
+
+    assert len(rows) == 22
+    assert rows[0] == ("user", "вопрос 0")
+
+
+def test_buffer_invalidated_only_after_real_summary(sqlite_db, monkeypatch):
+    _fresh_cache(monkeypatch)
+    summary = {"text": None}
+
+    async def fake_summary(messages):
+        return summary["text"]
+
+    monkeypatch.setattr(data_manager, "summarize_history", fake_summary)
+    cache = data_manager.conversation_cache
+
+    async def scenario():
+        user_id = await _add_user(sqlite_db)
+        for i in range(11):
+            await db.save_chat_message(user_id, "user", f"сообщение {i}")
+            await db.save_chat_message(user_id, "assistant", f"ответ {i}")
+        await data_manager.get_history(CHAT_ID, 30)
+        buffer = cache._buffers.get(CHAT_ID)
+
+        # Сводки нет — БД не тронута, буфер тот же
+        assert await data_manager.compress_history(CHAT_ID, user_id) is False
+        assert cache._buffers.get(CHAT_ID) is buffer
+        assert await db.get_all_messages_count(user_id) == 22
+
+        # Сводка записана — буфер сброшен и перечитан уже со сводкой
+        summary["text"] = "Краткое содержание ранней переписки: сводка"
+        assert await data_manager.compress_history(CHAT_ID, user_id) is True
+        assert CHAT_ID not in cache._buffers
+        history = await data_manager.get_history(CHAT_ID, 30)
+        return history
+
+    history = asyncio.run(scenario())
+    assert history[0]["content"] == "Краткое содержание ранней переписки: сводка"
+    assert len(history) == 13
+
+
+def test_concurrent_compressions_summarize_once(sqlite_db, monkeypatch):
+    _fresh_cache(monkeypatch)
+    calls = []
+
+    async def slow_summary(messages):
+        calls.append(len(messages))
+        await asyncio.sleep(0.05)
+        return "Краткое содержание ранней переписки: сводка"
+
+    monkeypatch.setattr(data_manager, "summarize_history", slow_summary)
+
+    async def scenario():
+        user_id = await _add_user(sqlite_db)
+        for i in range(11):
+            await db.save_chat_message(user_id, "user", f"сообщение {i}")
+            await db.save_chat_message(user_id, "assistant", f"ответ {i}")
+        return await asyncio.gather(
+            data_manager.compress_history(CHAT_ID, user_id),
+            data_manager.compress_history(CHAT_ID, user_id)
+        )
+
+    assert sorted(asyncio.run(scenario())) == [False, True]
+    assert calls == [10]
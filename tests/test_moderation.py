@@ -0,0 +1,31 @@
+import pytest
+
+import moderation
+
+
+@pytest.mark.parametrize("text", [
+    "а вы принимаете USDT? какой доход у клуба с абонементов, интересно",
+    "рядом с залом открыли казино, парковаться теперь негде",
+    "заработал 5 тысяч на фрилансе, куплю абонемент",
+    "напишите в личку, скину адрес зала",
+    "пассивный доход — это не про спорт, тут надо работать",
+])
+def test_ambiguous_messages_go_to_llm(text):
+    assert moderation.local_verdict(text) is None
+
+
+@pytest.mark.parametrize("text", [
+    "Пассивный доход без вложений! Пишите в лс",
+    "Доход от 5000 руб в день, всё расскажу",
+    "заработок 300$ за неделю на крипте",
+])
+def test_high_precision_spam_is_settled_locally(text):
+    verdict = moderation.local_verdict(text)
+    assert verdict is not None
+    assert verdict["tier"] == "spam_pattern"
+
+
+def test_short_clean_reply_is_settled_locally():
+    verdict = moderation.local_verdict("спасибо, до встречи!")
+    assert verdict is not None
+    assert verdict["tier"] == "short"
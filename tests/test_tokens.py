@@ -0,0 +1,42 @@
+import openai_module
+
+
+class _FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+def test_encoding_retried_after_backoff(monkeypatch):
+    now = {"t": 1000.0}
+    calls = []
+
+    def encoding_for_model(model):
+        calls.append(model)
+        if len(calls) < 3:
+            raise OSError("нет сети")
+        return _FakeEncoding()
+
+    monkeypatch.setattr(openai_module.time, "monotonic", lambda: now["t"])
+    monkeypatch.setattr(openai_module.tiktoken, "encoding_for_model", encoding_for_model)
+    monkeypatch.setattr(openai_module, "_encodings", {})
+    monkeypatch.setattr(openai_module, "_encoding_retry", {})
+    delay = openai_module.ENCODING_RETRY_DELAY
+
+    assert openai_module._encoding("m") is None
+    # До конца паузы словарь заново не грузим
+    now["t"] += delay - 1
+    assert openai_module._encoding("m") is None
+    assert len(calls) == 1
+
+    now["t"] += 1
+    assert openai_module._encoding("m") is None
+    assert len(calls) == 2
+    # Вторая неудача — пауза вдвое длиннее
+    now["t"] += delay
+    assert openai_module._encoding("m") is None
+    assert len(calls) == 2
+
+    now["t"] += delay
+    assert isinstance(openai_module._encoding("m"), _FakeEncoding)
+    assert openai_module.count_tokens("раз два три", "m") == 3
+    assert len(calls) == 3
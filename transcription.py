@@ -0,0 +1,138 @@
+import io
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional, List
+
+from aiogram.exceptions import TelegramBadRequest
+from cachetools import TTLCache
+
+from config import config
+from metrics import metrics
+from openai_module import send_to_whisper
+from single_flight import SingleFlight
+
+
+# =============================================================================
+# Скачивание голосовых в память
+# =============================================================================
+
+async def download_telegram_voice(bot, file_id: str) -> Optional[io.BytesIO]:
+    """
+    Аналог ваших функций telegramGetFilePath + downloadTelegramFile:
+    скачивает файл в память, без временных файлов на диске.
+    У буфера выставлено name (с расширением) — по нему Whisper узнаёт формат.
+    """
+    try:
+        file_info = await bot.get_file(file_id)
+    except TelegramBadRequest as e:
+        logging.error(f"Не удалось получить info по file_id={file_id}: {e}")
+        return None
+
+    if not file_info.file_path:
+        return None
+
+    buffer = await bot.download_file(file_path=file_info.file_path)
+    buffer.name = os.path.basename(file_info.file_path)
+    return buffer
+
+
+# =============================================================================
+# Очередь распознавания с ограниченным параллелизмом
+# =============================================================================
+
+class TranscriptionQueue:
+    """
+    Задания (скачать voice + распознать) обрабатывают workers воркеров;
+    ждать в очереди могут не больше max_queue заданий — лишние сразу
+    получают ошибку, а не копятся в памяти.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, bot, file_id: str, duration: Optional[float] = None) -> Dict[str, Any]:
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((bot, file_id, duration, future, time.monotonic()))
+        except asyncio.QueueFull:
+            metrics.inc("voice.rejected")
+            return {"error": "Слишком много голосовых в обработке, попробуйте чуть позже"}
+        metrics.gauge("voice.queue_depth", self._queue.qsize())
+        return await future
+
+    async def _worker(self) -> None:
+        while True:
+            bot, file_id, duration, future, enqueued_at = await self._queue.get()
+            metrics.gauge("voice.queue_depth", self._queue.qsize())
+            metrics.observe("voice.wait_ms", (time.monotonic() - enqueued_at) * 1000)
+            started = time.monotonic()
+            try:
+                result = await self._transcribe(bot, file_id, duration)
+            except Exception as e:
+                logging.error(f"Ошибка распознавания voice {file_id}: {e}")
+                result = {"error": f"Непредвиденная ошибка: {e}"}
+            finally:
+                self._queue.task_done()
+            metrics.observe("voice.transcribe_ms", (time.monotonic() - started) * 1000)
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    async def _transcribe(bot, file_id: str, duration: Optional[float]) -> Dict[str, Any]:
+        buffer = await download_telegram_voice(bot, file_id)
+        if buffer is None:
+            return {"error": "Не удалось скачать voice-файл"}
+        return await send_to_whisper(buffer, duration=duration)
+
+
+transcription_queue = TranscriptionQueue(
+    workers=config.VOICE_WORKERS,
+    max_queue=config.VOICE_QUEUE_MAX
+)
+
+
+# =============================================================================
+# Кеш расшифровок по file_unique_id
+# =============================================================================
+
+# file_unique_id одинаков у пересланных копий одного и того же голосового
+_transcripts: TTLCache = TTLCache(maxsize=config.VOICE_CACHE_SIZE, ttl=config.VOICE_CACHE_TTL)
+_in_flight = SingleFlight()
+
+
+async def transcribe_voice(
+    bot,
+    file_id: str,
+    file_unique_id: str,
+    duration: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Расшифровка голосового: {"text": ...} или {"error": ...}.
+    duration (сек, из message.voice) решает, резать ли запись на куски.
+    Повторы (в том числе одновременные) одного file_unique_id не уходят
+    в Whisper второй раз. Ошибки не кешируются.
+    """
+    cached = _transcripts.get(file_unique_id)
+    if cached is not None:
+        metrics.inc("voice.cache_hit")
+        return dict(cached)
+
+    async def transcribe():
+        result = await transcription_queue.submit(bot, file_id, duration)
+        if "error" not in result:
+            _transcripts[file_unique_id] = result
+        return result
+
+    result, shared = await _in_flight.run(file_unique_id, transcribe)
+    if shared:
+        metrics.inc("voice.cache_hit")
+    return dict(result)
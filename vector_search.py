@@ -1,2 +1,750 @@
-async def vectorSearch():
-    pass
\ No newline at end of file
+import re
+import json
+import math
+import asyncio
+import logging
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Optional, List, Dict, Any
+
+import numpy as np
+
+from config import config
+from db import get_all_doc_chunks
+from openai_module import get_embedding, get_embeddings, PRIORITY_INTERACTIVE
+
+
+# =============================================================================
+# Токенизация и стемминг (русский + латиница + числа вида "70.3")
+# =============================================================================
+
+# Числа с точкой/запятой держим одним токеном: "70.3", "1,9" -> "1.9"
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)*|[^\W\d_]+", re.UNICODE)
+
+_RU_VOWELS = "аеиоуыэюя"
+_RU_WORD_RE = re.compile(r"^[а-я]+$")
+
+# Окончания по алгоритму Snowball (Porter) для русского языка.
+# Группа 1 — только после "а"/"я" (сама буква остаётся в основе).
+_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+_ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий",
+    "ый", "ой", "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_REFLEXIVE = ("ся", "сь")
+_VERB_1 = (
+    "ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют",
+    "ны", "ть", "ешь", "нно",
+)
+_VERB_2 = (
+    "ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил",
+    "ыл", "им", "ым", "ен", "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт",
+    "ены", "ить", "ыть", "ишь", "ую", "ю",
+)
+_NOUN = (
+    "а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией",
+    "ей", "ой", "ий", "й", "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах",
+    "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я",
+)
+_SUPERLATIVE = ("ейше", "ейш")
+_DERIVATIONAL = ("ость", "ост")
+
+
+def _by_length(endings) -> tuple:
+    return tuple(sorted(endings, key=len, reverse=True))
+
+
+_PERFECTIVE_GERUND_1 = _by_length(_PERFECTIVE_GERUND_1)
+_PERFECTIVE_GERUND_2 = _by_length(_PERFECTIVE_GERUND_2)
+_ADJECTIVE = _by_length(_ADJECTIVE)
+_PARTICIPLE_1 = _by_length(_PARTICIPLE_1)
+_PARTICIPLE_2 = _by_length(_PARTICIPLE_2)
+_VERB_1 = _by_length(_VERB_1)
+_VERB_2 = _by_length(_VERB_2)
+_NOUN = _by_length(_NOUN)
+
+
+def _strip_ending(rv: str, endings: tuple, after_a_ya: bool = False) -> Optional[str]:
+    """
+    Отрезает самое длинное подходящее окончание. Возвращает новую строку
+    или None, если ни одно окончание не подошло.
+    """
+    for ending in endings:
+        if rv.endswith(ending):
+            if not after_a_ya:
+                return rv[:-len(ending)]
+            if len(rv) > len(ending) and rv[-len(ending) - 1] in "ая":
+                return rv[:-len(ending)]
+    return None
+
+
+def _strip_group(rv: str, group_1: tuple, group_2: tuple) -> Optional[str]:
+    result = _strip_ending(rv, group_2)
+    if result is not None:
+        return result
+    return _strip_ending(rv, group_1, after_a_ya=True)
+
+
+def _r_index(word: str, start: int) -> int:
+    """Позиция после первой согласной, стоящей за гласной (начиная со start)."""
+    for i in range(max(start, 1), len(word)):
+        if word[i] not in _RU_VOWELS and word[i - 1] in _RU_VOWELS:
+            return i + 1
+    return len(word)
+
+
+@lru_cache(maxsize=100_000)
+def stem_ru(word: str) -> str:
+    """
+    Стеммер Snowball для русского языка: "забегов", "забегами" -> "забег".
+    Слова не из кириллицы возвращаются как есть.
+    """
+    if not _RU_WORD_RE.match(word):
+        return word
+
+    rv_start = len(word)
+    for i, ch in enumerate(word):
+        if ch in _RU_VOWELS:
+            rv_start = i + 1
+            break
+    r1 = _r_index(word, 1)
+    r2 = _r_index(word, r1 + 1)
+
+    head, rv = word[:rv_start], word[rv_start:]
+
+    # Шаг 1
+    stripped = _strip_group(rv, _PERFECTIVE_GERUND_1, _PERFECTIVE_GERUND_2)
+    if stripped is not None:
+        rv = stripped
+    else:
+        stripped = _strip_ending(rv, _REFLEXIVE)
+        if stripped is not None:
+            rv = stripped
+
+        stripped = _strip_ending(rv, _ADJECTIVE)
+        if stripped is not None:
+            participle = _strip_group(stripped, _PARTICIPLE_1, _PARTICIPLE_2)
+            rv = participle if participle is not None else stripped
+        else:
+            stripped = _strip_group(rv, _VERB_1, _VERB_2)
+            if stripped is None:
+                stripped = _strip_ending(rv, _NOUN)
+            if stripped is not None:
+                rv = stripped
+
+    # Шаг 2
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    # Шаг 3: словообразовательный суффикс, целиком лежащий в R2
+    for ending in _DERIVATIONAL:
+        if rv.endswith(ending) and rv_start + len(rv) - len(ending) >= r2:
+            rv = rv[:-len(ending)]
+            break
+
+    # Шаг 4
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        stripped = _strip_ending(rv, _SUPERLATIVE)
+        if stripped is not None:
+            rv = stripped[:-1] if stripped.endswith("нн") else stripped
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+
+    return head + rv
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Разбивает текст на нормализованные термы для лексического индекса:
+    нижний регистр, ё -> е, числа "70,3" -> "70.3", стемминг русских слов.
+    """
+    text = text.lower().replace("ё", "е")
+    terms = []
+    for token in _TOKEN_RE.findall(text):
+        if token[0].isdigit():
+            terms.append(token.replace(",", "."))
+        elif len(token) > 1:
+            terms.append(stem_ru(token))
+    return terms
+
+
+# =============================================================================
+# Лексический индекс (инвертированный, BM25)
+# =============================================================================
+
+class LexicalIndex:
+    """
+    Инвертированный индекс: терм -> {номер документа: частота}.
+    Скоринг BM25 (k1, b — классические значения). Документы можно
+    добавлять и удалять по одному, idf считается на лету.
+    """
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_len: Dict[int, int] = {}
+        self.total_len = 0
+
+        for doc_idx, text in enumerate(texts):
+            self.add(doc_idx, text)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, doc_idx: int, text: str) -> None:
+        terms = tokenize(text)
+        self.doc_len[doc_idx] = len(terms)
+        self.total_len += len(terms)
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[doc_idx] = tf
+
+    def remove(self, doc_idx: int, text: str) -> None:
+        length = self.doc_len.pop(doc_idx, None)
+        if length is None:
+            return
+        self.total_len -= length
+        for term in set(tokenize(text)):
+            docs = self.postings.get(term)
+            if docs is None:
+                continue
+            docs.pop(doc_idx, None)
+            if not docs:
+                del self.postings[term]
+
+    def search(self, query: str, top_k: int) -> List[tuple]:
+        """Возвращает [(номер документа, score), ...] по убыванию score."""
+        n_docs = self.n_docs
+        if not n_docs:
+            return []
+
+        scores: Dict[int, float] = {}
+        norm = self.k1 * (1.0 - self.b)
+        norm_len = self.k1 * self.b / ((self.total_len / n_docs) or 1.0)
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_idx, tf in docs.items():
+                denom = tf + norm + norm_len * self.doc_len[doc_idx]
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + idf * tf * (self.k1 + 1.0) / denom
+
+        best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        return best[:top_k]
+
+
+# =============================================================================
+# Векторные индексы: точный, int8-квантованный, приближённый (IVF)
+# =============================================================================
+
+def _normalize_rows(vectors) -> tuple:
+    """Нормирует строки; возвращает (матрица, маска нулевых строк)."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    zero_rows = norms[:, 0] == 0
+    norms[zero_rows] = 1.0
+    return matrix / norms, zero_rows
+
+
+def _top_k_rows(scores: np.ndarray, k: int) -> tuple:
+    """top-k по каждой строке матрицы скоров: (индексы, скоры), по убыванию."""
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class VectorIndex:
+    """
+    Точный поиск: матрица нормированных эмбеддингов (N x d, float32).
+    doc_ids[i] — номер документа в общем списке чанков.
+    """
+
+    def __init__(self, vectors: List[List[float]], doc_ids: List[int]):
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if vectors:
+            self.matrix, _ = _normalize_rows(vectors)
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.doc_ids.nbytes
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        return queries @ self.matrix.T
+
+    def _append_rows(self, rows: np.ndarray) -> None:
+        self.matrix = np.vstack([self.matrix, rows]) if self.matrix.size else rows
+
+    def _keep_rows(self, mask: np.ndarray) -> None:
+        self.matrix = self.matrix[mask]
+
+    def add(self, vectors: List[List[float]], doc_ids: List[int]) -> None:
+        """Добавляет векторы без перестроения индекса."""
+        if not vectors:
+            return
+        rows, _ = _normalize_rows(vectors)
+        self._append_rows(rows)
+        self.doc_ids = np.concatenate([self.doc_ids, np.asarray(doc_ids, dtype=np.int64)])
+
+    def remove(self, doc_ids: List[int]) -> None:
+        if not doc_ids or not len(self.doc_ids):
+            return
+        mask = ~np.isin(self.doc_ids, np.asarray(doc_ids, dtype=np.int64))
+        self._keep_rows(mask)
+        self.doc_ids = self.doc_ids[mask]
+
+    def search(self, query_vec: List[float], top_k: int) -> List[tuple]:
+        """Возвращает [(номер документа, cosine), ...] по убыванию score."""
+        return self.search_many([query_vec], top_k)[0]
+
+    def search_many(
+        self,
+        query_vecs: List[List[float]],
+        top_k: int,
+        block_rows: int = 1024
+    ) -> List[List[tuple]]:
+        """
+        Пакетный поиск: запросы складываются в матрицу Q (m x d), скоры
+        считаются одним произведением Q @ M.T, top-k — argpartition по строкам.
+        Запросы обрабатываются блоками по block_rows, чтобы матрица скоров
+        не разрасталась на десятках тысяч запросов.
+        """
+        if not query_vecs:
+            return []
+        if not len(self.doc_ids):
+            return [[] for _ in query_vecs]
+
+        queries, zero_rows = _normalize_rows(query_vecs)
+        k = min(top_k, len(self.doc_ids))
+        results: List[List[tuple]] = []
+        for start in range(0, len(queries), block_rows):
+            top, top_scores = _top_k_rows(self._scores(queries[start:start + block_rows]), k)
+            for row in range(len(top)):
+                if zero_rows[start + row]:
+                    results.append([])
+                    continue
+                results.append([
+                    (int(self.doc_ids[i]), float(score))
+                    for i, score in zip(top[row], top_scores[row])
+                ])
+        return results
+
+
+class QuantizedVectorIndex(VectorIndex):
+    """
+    Та же матрица, но в int8 с масштабом на каждое измерение:
+    в 4 раза меньше памяти ценой небольшой потери точности скоров.
+    """
+
+    def __init__(self, vectors: List[List[float]], doc_ids: List[int], block_docs: int = 8192):
+        super().__init__(vectors, doc_ids)
+        self.block_docs = block_docs
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.codes = np.zeros((0, 0), dtype=np.int8)
+        if self.matrix.size:
+            self._append_rows(self.matrix)
+        # float32-копия больше не нужна
+        self.matrix = None
+
+    def _append_rows(self, rows: np.ndarray) -> None:
+        if not self.scales.size:
+            scales = np.abs(rows).max(axis=0) / 127.0
+            scales[scales == 0] = 1.0
+            self.scales = scales.astype(np.float32)
+        # Новые векторы квантуются старыми масштабами (с обрезкой)
+        codes = np.clip(np.round(rows / self.scales), -127, 127).astype(np.int8)
+        self.codes = np.vstack([self.codes, codes]) if self.codes.size else codes
+
+    def _keep_rows(self, mask: np.ndarray) -> None:
+        self.codes = self.codes[mask]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes + self.doc_ids.nbytes
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        scaled = queries * self.scales
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_docs):
+            block = self.codes[start:start + self.block_docs].astype(np.float32)
+            scores[:, start:start + len(block)] = scaled @ block.T
+        return scores
+
+
+class IVFVectorIndex(VectorIndex):
+    """
+    Приближённый поиск (IVF): векторы разбиты сферическим k-means на nlist
+    кластеров; запрос сравнивается только с векторами nprobe ближайших кластеров.
+    """
+
+    def __init__(
+        self,
+        vectors: List[List[float]],
+        doc_ids: List[int],
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        iterations: int = 10,
+        seed: int = 0
+    ):
+        super().__init__(vectors, doc_ids)
+        n = len(self.matrix) if self.matrix.size else 0
+        self.nlist = max(1, min(nlist or int(math.sqrt(n)) or 1, n or 1))
+        self.max_nprobe = nprobe
+        self.iterations = iterations
+        self.rng = np.random.default_rng(seed)
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assign = np.zeros(0, dtype=np.int64)
+        self.lists: List[np.ndarray] = []
+        if n:
+            self._train()
+
+    def _train(self) -> None:
+        data, rng = self.matrix, self.rng
+        centroids = data[rng.choice(len(data), self.nlist, replace=False)]
+        for _ in range(self.iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, data)
+            empty = np.bincount(assign, minlength=self.nlist) == 0
+            # Пустые кластеры переинициализируем случайными точками
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            centroids, _ = _normalize_rows(sums)
+        self.centroids = centroids
+        self.assign = np.argmax(data @ centroids.T, axis=1)
+        self._rebuild_lists()
+
+    @property
+    def nprobe(self) -> int:
+        return min(self.max_nprobe, self.nlist)
+
+    def _rebuild_lists(self) -> None:
+        self.lists = [np.flatnonzero(self.assign == c) for c in range(self.nlist)]
+
+    def _append_rows(self, rows: np.ndarray) -> None:
+        # Центроиды не переобучаем: новые векторы попадают в ближайший кластер
+        super()._append_rows(rows)
+        if not self.centroids.size:
+            self.nlist = max(1, int(math.sqrt(len(self.matrix))))
+            self._train()
+            return
+        self.assign = np.concatenate([self.assign, np.argmax(rows @ self.centroids.T, axis=1)])
+        self._rebuild_lists()
+
+    def _keep_rows(self, mask: np.ndarray) -> None:
+        super()._keep_rows(mask)
+        self.assign = self.assign[mask]
+        self._rebuild_lists()
+
+    @property
+    def nbytes(self) -> int:
+        return super().nbytes + self.centroids.nbytes + sum(l.nbytes for l in self.lists)
+
+    def search_many(
+        self,
+        query_vecs: List[List[float]],
+        top_k: int,
+        block_rows: int = 1024
+    ) -> List[List[tuple]]:
+        if not query_vecs:
+            return []
+        if not len(self.doc_ids):
+            return [[] for _ in query_vecs]
+
+        queries, zero_rows = _normalize_rows(query_vecs)
+        probes, _ = _top_k_rows(queries @ self.centroids.T, self.nprobe)
+
+        results: List[List[tuple]] = []
+        for row, q in enumerate(queries):
+            if zero_rows[row]:
+                results.append([])
+                continue
+            candidates = np.concatenate([self.lists[c] for c in probes[row]])
+            if not len(candidates):
+                results.append([])
+                continue
+            scores = self.matrix[candidates] @ q
+            k = min(top_k, len(candidates))
+            top, top_scores = _top_k_rows(scores[None, :], k)
+            results.append([
+                (int(self.doc_ids[candidates[i]]), float(score))
+                for i, score in zip(top[0], top_scores[0])
+            ])
+        return results
+
+
+VECTOR_INDEX_TYPES = {
+    "exact": VectorIndex,
+    "int8": QuantizedVectorIndex,
+    "ivf": IVFVectorIndex,
+}
+
+
+def reciprocal_rank_fusion(rankings: List[List[tuple]], k: int = 60) -> List[tuple]:
+    """
+    RRF: score(d) = sum(1 / (k + rank(d))) по всем спискам.
+    На входе — списки [(номер документа, score), ...], отсортированные по убыванию.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (doc_idx, _) in enumerate(ranking, start=1):
+            fused[doc_idx] = fused.get(doc_idx, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+
+# =============================================================================
+# Общий индекс по doc_chunks
+# =============================================================================
+
+def _parse_embedding(emb) -> Optional[List[float]]:
+    if isinstance(emb, str):
+        try:
+            emb = json.loads(emb)
+        except json.JSONDecodeError:
+            return None
+    if emb is None or not len(emb):
+        return None
+    return emb
+
+
+class RetrievalIndex:
+    """
+    Векторный и лексический индексы, построенные по одному списку чанков.
+    Номер документа (doc_idx) — позиция в self.chunks; удалённые чанки
+    остаются там как None, чтобы номера не сдвигались.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]], vector_index: Optional[str] = None):
+        self.chunks: List[Optional[Dict[str, Any]]] = []
+        self.positions: Dict[Any, int] = {}
+        self._lock = threading.Lock()
+
+        index_cls = VECTOR_INDEX_TYPES[vector_index or config.RAG_VECTOR_INDEX]
+        vectors, doc_ids = self._add_chunks(rows)
+        self.vector = index_cls(vectors, doc_ids)
+        self.lexical = LexicalIndex([c["chunk_text"] for c in self.chunks])
+
+    def _add_chunks(self, rows: List[Dict[str, Any]]) -> tuple:
+        """Регистрирует чанки; возвращает (векторы, их doc_idx) для векторного индекса."""
+        vectors, doc_ids = [], []
+        for r in rows:
+            doc_idx = len(self.chunks)
+            self.chunks.append({"id": r["id"], "chunk_text": r.get("chunk_text") or ""})
+            self.positions[r["id"]] = doc_idx
+            emb = _parse_embedding(r.get("embedding"))
+            if emb is not None:
+                vectors.append(emb)
+                doc_ids.append(doc_idx)
+        return vectors, doc_ids
+
+    def apply_changes(self, added: List[Dict[str, Any]], removed_ids: List[Any]) -> None:
+        """
+        Инкрементальное обновление: added — строки doc_chunks (id, chunk_text,
+        embedding), removed_ids — id удалённых чанков.
+        """
+        with self._lock:
+            removed = [self.positions.pop(i) for i in removed_ids if i in self.positions]
+            for doc_idx in removed:
+                self.lexical.remove(doc_idx, self.chunks[doc_idx]["chunk_text"])
+                self.chunks[doc_idx] = None
+            self.vector.remove(removed)
+
+            first_new = len(self.chunks)
+            vectors, doc_ids = self._add_chunks(added)
+            for doc_idx in range(first_new, len(self.chunks)):
+                self.lexical.add(doc_idx, self.chunks[doc_idx]["chunk_text"])
+            self.vector.add(vectors, doc_ids)
+
+    def _to_results(
+        self,
+        ranked: List[tuple],
+        similarity: Optional[Dict[int, float]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        similarity — косинус запроса с чанком (если считался): по нему,
+        в отличие от score RRF/BM25, можно судить об уверенности совпадения.
+        """
+        similarity = similarity or {}
+        return [
+            {**self.chunks[doc_idx], "score": score, "similarity": similarity.get(doc_idx)}
+            for doc_idx, score in ranked
+        ]
+
+    def search_lexical(self, query: str, top_k: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._to_results(self.lexical.search(query, top_k))
+
+    def search_vector(self, query_vec: List[float], top_k: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            ranked = self.vector.search(query_vec, top_k)
+            return self._to_results(ranked, dict(ranked))
+
+    def search_hybrid(
+        self,
+        query: str,
+        query_vec: Optional[List[float]],
+        top_k: int,
+        rrf_k: int = 60
+    ) -> List[Dict[str, Any]]:
+        return self.search_many(
+            [query], [query_vec], top_k, mode="hybrid", rrf_k=rrf_k
+        )[0]
+
+    def search_many(
+        self,
+        queries: List[str],
+        query_vecs: List[Optional[List[float]]],
+        top_k: int,
+        mode: str = "hybrid",
+        rrf_k: int = 60
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Пакетный поиск. query_vecs[i] может быть None — тогда для i-го
+        запроса используется только BM25.
+        """
+        with self._lock:
+            return self._search_many(queries, query_vecs, top_k, mode, rrf_k)
+
+    def _search_many(self, queries, query_vecs, top_k: int, mode: str, rrf_k: int):
+        # Кандидатов для слияния берём с запасом, чтобы RRF был осмысленным
+        depth = top_k if mode == "vector" else max(top_k * 4, 20)
+
+        with_vec = [i for i, v in enumerate(query_vecs) if v is not None]
+        vector_ranked: Dict[int, List[tuple]] = {}
+        if mode != "lexical" and with_vec:
+            batch = self.vector.search_many([query_vecs[i] for i in with_vec], depth)
+            vector_ranked = dict(zip(with_vec, batch))
+
+        results = []
+        for i, query in enumerate(queries):
+            vector = vector_ranked.get(i)
+            if vector is None:
+                ranked = self.lexical.search(query, top_k)
+            elif mode == "vector":
+                ranked = vector
+            else:
+                lexical = self.lexical.search(query, depth)
+                ranked = reciprocal_rank_fusion([vector, lexical], rrf_k)
+            results.append(self._to_results(ranked[:top_k], dict(vector) if vector else None))
+        return results
+
+
+_index: Optional[RetrievalIndex] = None
+_index_lock = asyncio.Lock()
+# Растёт при каждой перестройке/изменении индекса: по нему кеши ответов,
+# построенных на базе знаний, понимают, что устарели
+_index_version = 0
+
+
+def index_version() -> int:
+    return _index_version
+
+
+async def load_index(force: bool = False) -> RetrievalIndex:
+    """
+    Строит (или перестраивает при force=True) индекс по таблице doc_chunks.
+    """
+    global _index, _index_version
+    async with _index_lock:
+        if _index is None or force:
+            rows = await get_all_doc_chunks()
+            _index = await asyncio.to_thread(RetrievalIndex, rows)
+            _index_version += 1
+            logging.info(f"RAG-индекс построен: {len(rows)} чанков")
+    return _index
+
+
+async def apply_changes(added: List[Dict[str, Any]], removed_ids: List[Any]) -> None:
+    """
+    Переносит изменения doc_chunks в уже построенный индекс.
+    Если индекс ещё не строился, он и так прочитает актуальную таблицу.
+    """
+    global _index_version
+    async with _index_lock:
+        if _index is None:
+            return
+        await asyncio.to_thread(_index.apply_changes, added, removed_ids)
+        if added or removed_ids:
+            _index_version += 1
+
+
+async def embed_query(query: str) -> Optional[List[float]]:
+    """
+    Эмбеддинг запроса с таймаутом: если API медленное, возвращаем None,
+    и поиск продолжается только по лексическому индексу.
+    """
+    try:
+        return await asyncio.wait_for(get_embedding(query), timeout=config.RAG_EMBED_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Эмбеддинг запроса не успел, используем лексический поиск")
+        return None
+
+
+async def vectorSearch(
+    query: str,
+    top_k: int = 3,
+    mode: Optional[str] = None,
+    query_vec: Optional[List[float]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Поиск по doc_chunks. Возвращает [{"id", "chunk_text", "score", "similarity"}, ...]
+    (similarity — косинус с запросом, None если эмбеддинг запроса не получен
+    или чанк найден только BM25).
+
+    mode:
+      "vector"  — только эмбеддинги (косинус);
+      "lexical" — только BM25, без обращения к API;
+      "hybrid"  — RRF по обоим спискам (по умолчанию, config.RAG_SEARCH_MODE).
+    Если эмбеддинг не получен вовремя, "vector" и "hybrid" откатываются на BM25.
+    query_vec — уже посчитанный embed_query(query) (например, параллельно
+    с другими делами); если не передан, считается здесь.
+    Сам поиск (numpy/BM25) идёт в отдельном потоке, как в search_many, —
+    чтобы не блокировать event loop обоих ботов.
+    """
+    mode = mode or config.RAG_SEARCH_MODE
+    index = await load_index()
+
+    if mode == "lexical":
+        return await asyncio.to_thread(index.search_lexical, query, top_k)
+
+    if query_vec is None:
+        query_vec = await embed_query(query)
+    if query_vec is None:
+        return await asyncio.to_thread(index.search_lexical, query, top_k)
+
+    if mode == "vector":
+        return await asyncio.to_thread(index.search_vector, query_vec, top_k)
+    return await asyncio.to_thread(index.search_hybrid, query, query_vec, top_k)
+
+
+async def search_many(
+    queries: List[str],
+    top_k: int = 3,
+    mode: Optional[str] = None
+) -> List[List[Dict[str, Any]]]:
+    """
+    Пакетный аналог vectorSearch: один запрос эмбеддингов на все строки
+    и одно матричное произведение по индексу. Результат — список
+    результатов vectorSearch в порядке queries.
+    """
+    if not queries:
+        return []
+
+    mode = mode or config.RAG_SEARCH_MODE
+    index = await load_index()
+
+    if mode == "lexical":
+        query_vecs = [None] * len(queries)
+    else:
+        query_vecs = await get_embeddings(queries, priority=PRIORITY_INTERACTIVE)
+
+    return await asyncio.to_thread(index.search_many, queries, query_vecs, top_k, mode)
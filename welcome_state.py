@@ -0,0 +1,121 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import aiofiles
+
+from config import config
+from metrics import metrics
+
+
+# =============================================================================
+# Активные приветствия по чатам: память + асинхронный снимок на диск
+# =============================================================================
+
+class WelcomeState:
+    """
+    Активное приветствие каждого чата ({chat_id, message_id, created_at,
+    mentioned}) хранится в памяти. Обработка входа в чат идёт под
+    блокировкой этого чата (lock(chat_id)): одновременные JOIN одного чата
+    выполняются по очереди, разных чатов — параллельно.
+
+    На диск (CURRENT_WELCOME_FILE) состояние пишется в фоне снимком всех
+    чатов — только чтобы пережить перезапуск; запросы его не читают.
+    Изменения, пришедшие во время записи, попадут в следующий снимок.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._states: Dict[int, dict] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._dirty = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        return lock
+
+    def get(self, chat_id: int) -> Optional[dict]:
+        state = self._states.get(chat_id)
+        return dict(state) if state is not None else None
+
+    def set(self, chat_id: int, state: dict) -> None:
+        self._states[chat_id] = dict(state, chat_id=chat_id)
+        self._changed()
+
+    def pop(self, chat_id: int) -> Optional[dict]:
+        state = self._states.pop(chat_id, None)
+        lock = self._locks.get(chat_id)
+        if lock is not None and not lock.locked():
+            del self._locks[chat_id]
+        if state is not None:
+            self._changed()
+        return state
+
+    def chats(self) -> List[int]:
+        return list(self._states)
+
+    # -------------------------------------------------------------------------
+    # Снимок на диск
+    # -------------------------------------------------------------------------
+
+    def _changed(self) -> None:
+        metrics.gauge("welcome.active", len(self._states))
+        self._dirty = True
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self._write(dict(self._states))
+            except Exception as e:
+                logging.error(f"Не удалось сохранить {self.path}: {e}")
+                return
+
+    async def _write(self, states: Dict[int, dict]) -> None:
+        # Пишем во временный файл и подменяем: при сбое старый снимок цел
+        tmp_path = f"{self.path}.tmp"
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            await f.write(json.dumps({str(k): v for k, v in states.items()}))
+        os.replace(tmp_path, self.path)
+        metrics.inc("welcome.snapshots")
+
+    async def load(self) -> None:
+        """Восстанавливаем состояние после перезапуска (вызывается из main)."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            async with aiofiles.open(self.path, "r", encoding="utf-8") as f:
+                raw = await f.read()
+            data = json.loads(raw) if raw.strip() else {}
+        except Exception as e:
+            logging.error(f"Не смогли прочитать {self.path}: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        if "message_id" in data:
+            # Старый формат: одно приветствие на весь бот
+            data = {str(data.get("chat_id")): data}
+        for key, state in data.items():
+            if isinstance(state, dict) and state.get("message_id"):
+                try:
+                    self._states[int(key)] = state
+                except ValueError:
+                    continue
+        metrics.gauge("welcome.active", len(self._states))
+
+    async def flush(self) -> None:
+        """Дописать последний снимок (при остановке бота)."""
+        if self._writer is not None and not self._writer.done():
+            await self._writer
+        if self._dirty:
+            await self._write_loop()
+
+
+welcome_state = WelcomeState(config.CURRENT_WELCOME_FILE)